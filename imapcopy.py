@@ -9,12 +9,30 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import os
+import re
 import sys
+import csv
+import json
+import time
+import random
+import queue
+import shlex
+import socket
+import base64
+import sqlite3
+import zlib
 import hashlib
 import imaplib
+import tempfile
 import logging
 import argparse
-import email 
+import threading
+import contextlib
+import collections
+import email.parser
+import multiprocessing
+import concurrent.futures
 
 # Define ANSI color codes
 RED = '\033[91m'
@@ -26,6 +44,1325 @@ CYAN = '\033[96m'
 RESET = '\033[0m'
 BOLD = '\033[1m'
 
+# Seconds a connection may stay silent before it is considered dead
+TIMEOUT = 120
+
+# Reconnect attempts per folder without progress, and the backoff between them
+RETRIES = 8
+BACKOFF = 2
+MAX_BACKOFF = 300
+
+# Phases timed by the migration statistics, and the default number of
+# seconds between two progress records
+PHASES = ('select', 'search', 'fetch', 'parse', 'duplicate_check', 'append')
+METRICS_INTERVAL = 10
+
+# Messages of at least this size are copied on a lane of their own, with
+# this timeout, so they do not hold up the small ones
+LARGE_MESSAGE = 10 * 1024 * 1024
+LARGE_TIMEOUT = 600
+
+# Number of UIDs requested per FETCH when indexing or scanning a folder
+INDEX_CHUNK_SIZE = 1000
+
+# Default limits for one batched UID FETCH of message bodies
+BATCH_SIZE = 50
+BATCH_BYTES = 20 * 1024 * 1024
+
+# Message literals bigger than this are spooled to a temporary file
+# instead of being held in memory
+SPOOL_THRESHOLD = 1024 * 1024
+
+# Size of the pieces spooled messages are read and written in
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+# Number of UIDs covered by one UID SEARCH when listing a folder
+SEARCH_CHUNK_SIZE = 50000
+
+# Attributes fetched for every source message while planning a copy
+# Mails are matched by Message-ID, or by a fingerprint of their size,
+# INTERNALDATE and these headers when they have none
+FINGERPRINT_HEADERS = ('Date', 'From', 'To', 'Subject')
+KEY_ITEMS = 'RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID %s)]' % (
+    ' '.join(FINGERPRINT_HEADERS).upper())
+
+PLAN_ITEMS = '(UID FLAGS %s)' % KEY_ITEMS
+INDEX_ITEMS = '(%s)' % KEY_ITEMS
+
+# Items compared by the quick and the deep verification pass
+STATUS_ITEMS = '(MESSAGES UIDNEXT UIDVALIDITY)'
+VERIFY_ITEMS = '(UID %s)' % KEY_ITEMS
+
+_fetch_start_re = re.compile(rb'^\d+ \(')
+_status_re = re.compile(rb'^(?:"((?:[^"\\]|\\.)*)"|(\S*)) ?\((.*)\)$')
+_status_item_re = re.compile(rb'([A-Z-]+) (\d+)')
+_list_re = re.compile(rb'^\(([^)]*)\) (?:"((?:[^"\\]|\\.)*)"|NIL) ?(.*)$', re.I)
+_mutf7_re = re.compile(r'&([A-Za-z0-9+,]*)-')
+# One attribute of a FETCH response with its value.  The name may be a
+# section like BODY[HEADER.FIELDS (...)]; the value a list without nested
+# lists, strings or literals (FLAGS, MODSEQ), a quoted string, a literal
+# marker or an atom.  A line made of nothing but these, optionally closed
+# by the parenthesis ending the message, is parsed in one go; anything
+# else is left to the token by token parser.
+_FETCH_NAME = rb'[A-Za-z0-9.\-]+(?:\[[^\]]*\](?:<[\d.]+>)?)?'
+_FETCH_VALUES = (rb'[^\s()"{]+', rb'\([^()"{]*\)', rb'"[^"\\]*(?:\\.[^"\\]*)*"', rb'\{\d+\+?\}')
+_fetch_attribute_re = re.compile(rb' ?(%s) (?:(%s)|(%s)|(%s)|(%s))' % ((_FETCH_NAME,) + _FETCH_VALUES))
+_fetch_attributes_re = re.compile(rb'(?: ?%s (?:%s|%s|%s|%s))*[ \t]*(\))?[ \t]*' % ((_FETCH_NAME,) + _FETCH_VALUES))
+_fetch_token_re = re.compile(rb'[ \t]*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\+?\}|'
+                             rb'([^\s()"{\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?))')
+_quoted_pair_re = re.compile(rb'\\(.)')
+# A line announcing a whole message literal, the only kind worth spooling
+_message_literal_re = re.compile(rb'(?:BODY\[\]|BINARY\[\]|RFC822)(?:<\d+>)? \{\d+\}\r?\n$')
+_throttled_re = re.compile(rb'\[(THROTTLED|UNAVAILABLE|LIMIT|INUSE|OVERQUOTA)\]|too many|'
+                           rb'rate limit|bandwidth limit|try again later', re.I)
+_appenduid_re = re.compile(rb'\[APPENDUID (\d+) (\d+)\]')
+_copyuid_re = re.compile(rb'\[?COPYUID (\d+) ([\d:,]+) ([\d:,]+)')
+
+
+def clean_message_id(message_id):
+    # Message-IDs are compared without any whitespace or folding so that
+    # the same header written by two different servers still matches.
+    return ''.join(message_id.split())
+
+
+def message_fingerprint(headers, size, internaldate):
+    # Stand-in for a missing Message-ID, made of what an APPEND keeps: the
+    # size, the INTERNALDATE and a few headers.  Fetching these costs no
+    # more than the Message-ID, so no body has to be downloaded.
+    timestamp = None
+    if internaldate:
+        parsed = imaplib.Internaldate2tuple(('INTERNALDATE %s' % internaldate).encode('ascii', 'replace'))
+        if parsed is not None:
+            timestamp = int(time.mktime(parsed))
+    digest = hashlib.sha1(('%s\0%s\0' % (size, timestamp)).encode('ascii'))
+    for name in FINGERPRINT_HEADERS:
+        value = headers.get(name, '') if headers is not None else ''
+        digest.update((' '.join(str(value).split()) + '\0').encode('utf-8', 'replace'))
+    return 'fingerprint:' + digest.hexdigest()
+
+
+def clean_flags(flags):
+    # Remove the \Recent flag, servers refuse it on APPEND
+    flags = b' '.join(f for f in flags.split() if f.lower() != b'\\recent')
+    if not flags:
+        return None
+    return '(' + flags.decode('ascii') + ')'
+
+
+class Spool(object):
+    # A message literal kept in a temporary file.  The SHA-1 digest is
+    # computed while the literal is read from the server, and the literal
+    # is written to the destination straight from the file.  Messages from
+    # the cache come with their file and digest.
+
+    def __init__(self, size, file=None, digest=None):
+        self.size = size
+        self.file = file if file is not None else tempfile.TemporaryFile()
+        self.sha1 = hashlib.sha1()
+        self.digest = digest
+
+    def __len__(self):
+        return self.size
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.sha1.update(chunk)
+
+    def chunks(self):
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(SPOOL_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+def message_digest(message):
+    if isinstance(message, Spool):
+        return message.digest or message.sha1.hexdigest()
+    return hashlib.sha1(message).hexdigest()
+
+
+class InflatingReader(object):
+    # Stands in for the socket file of a connection once COMPRESS=DEFLATE
+    # is active: inflates what the server sends and hands imaplib whole
+    # lines and literals, counting the compressed bytes on the wire.
+
+    def __init__(self, file, metrics=None):
+        self.file = file
+        self.metrics = metrics
+        self._inflate = zlib.decompressobj(-15)
+        self._buffer = bytearray()
+
+    def _fill(self):
+        data = self.file.read1(SPOOL_CHUNK_SIZE)
+        if not data:
+            return False
+        if self.metrics is not None:
+            self.metrics.wire_in += len(data)
+        self._buffer += self._inflate.decompress(data)
+        return True
+
+    def read(self, size):
+        while len(self._buffer) < size and self._fill():
+            pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, limit=-1):
+        start = 0
+        while True:
+            end = self._buffer.find(b'\n', start)
+            if end >= 0:
+                end += 1
+                break
+            if 0 <= limit <= len(self._buffer):
+                break
+            start = len(self._buffer)
+            if not self._fill():
+                end = len(self._buffer)
+                break
+        if end < 0 or 0 <= limit < end:
+            end = limit
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class StreamingMixin(object):
+    # imaplib connection that spools big literals to disk while reading,
+    # streams them back out on APPEND, and sends messages without the
+    # copy imaplib makes to normalize line endings.
+    spool_threshold = 0
+    throttle = None
+    metrics = None
+    _deflate = None
+    _message_literal = False
+
+    def _simple_command(self, name, *args):
+        # Every command goes through the throttle of its host, which paces
+        # and limits commands and learns from their latency and from the
+        # server saying it is throttling us.  Plain disconnects are left to
+        # the reconnect backoff.
+        if self.metrics is not None:
+            self.metrics.commands += 1
+        throttle = self.throttle
+        if throttle is None:
+            return super()._simple_command(name, *args)
+        with throttle:
+            start = time.monotonic()
+            try:
+                typ, data = super()._simple_command(name, *args)
+            except self.abort as e:
+                # A BYE can carry the reason the server hangs up on us
+                if _throttled_re.search(str(e).encode('utf-8', 'replace')):
+                    throttle.failure()
+                raise
+            except self.error as e:
+                if _throttled_re.search(str(e).encode('utf-8', 'replace')):
+                    throttle.failure()
+                    raise ThrottledError(str(e))
+                raise
+        if typ != 'OK' and any(_throttled_re.search(d) for d in data if isinstance(d, bytes)):
+            throttle.failure()
+            raise ThrottledError('%s throttled by server: %s' % (name, data))
+        # Only commands whose cost does not grow with message size tell
+        # anything about how busy the server is
+        if name == 'UID':
+            name = 'UID %s' % args[0]
+            if 'BODY.PEEK[]' in str(args[-1]):
+                name = None
+        elif name == 'APPEND':
+            name = None
+        throttle.success(name, time.monotonic() - start)
+        return typ, data
+
+    def _create_socket(self, *args):
+        sock = super()._create_socket(*args)
+        # Commands, literals and their closing CRLF are separate writes,
+        # don't let Nagle's algorithm hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def readline(self):
+        line = super().readline()
+        if self.metrics is not None:
+            self.metrics.bytes_in += len(line)
+        # Header fields, LIST and STATUS literals are parsed right away
+        # and stay in memory whatever their size
+        self._message_literal = _message_literal_re.search(line) is not None
+        return line
+
+    def read(self, size):
+        if self.metrics is not None:
+            self.metrics.bytes_in += size
+        if not self.spool_threshold or size <= self.spool_threshold or not self._message_literal:
+            return super().read(size)
+        spool = Spool(size)
+        remaining = size
+        while remaining > 0:
+            chunk = super().read(min(remaining, SPOOL_CHUNK_SIZE))
+            if not chunk:
+                raise self.abort('socket error: EOF while reading literal')
+            spool.write(chunk)
+            remaining -= len(chunk)
+        return spool
+
+    def send(self, data):
+        if self.metrics is not None:
+            self.metrics.bytes_out += len(data)
+        chunks = data.chunks() if isinstance(data, Spool) else (data,)
+        if self._deflate is None:
+            for chunk in chunks:
+                super().send(chunk)
+            return
+        # Every write is flushed so the server sees complete commands and
+        # literals without waiting for more data
+        for chunk in chunks:
+            self._send_deflated(self._deflate.compress(chunk))
+        self._send_deflated(self._deflate.flush(zlib.Z_SYNC_FLUSH))
+
+    def _send_deflated(self, data):
+        if not data:
+            return
+        if self.metrics is not None:
+            self.metrics.wire_out += len(data)
+        super().send(data)
+
+    def compress(self):
+        # RFC 4978: once the server accepts COMPRESS DEFLATE, everything
+        # after its response is a raw deflate stream in both directions
+        typ, data = self.xatom('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            raise self.error('COMPRESS failed: %s' % data)
+        if self.metrics is not None:
+            self.metrics.start_compression()
+        self.file = InflatingReader(self.file, self.metrics)
+        self._deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+        return typ, data
+
+    def append(self, mailbox, flags, date_time, message):
+        if not mailbox:
+            mailbox = 'INBOX'
+        if flags:
+            if (flags[0], flags[-1]) != ('(', ')'):
+                flags = '(%s)' % flags
+        else:
+            flags = None
+        if date_time:
+            date_time = imaplib.Time2Internaldate(date_time)
+        else:
+            date_time = None
+        # Messages fetched from an IMAP server already use CRLF, only fix
+        # them up when they contain bare line endings
+        if not isinstance(message, Spool) and message.count(b'\n') != message.count(b'\r\n'):
+            message = imaplib.MapCRLF.sub(imaplib.CRLF, message)
+        self.literal = message
+        return self._simple_command('APPEND', mailbox, flags, date_time)
+
+
+class IMAP4(StreamingMixin, imaplib.IMAP4):
+    pass
+
+
+class IMAP4_SSL(StreamingMixin, imaplib.IMAP4_SSL):
+    pass
+
+
+class MemoryBudget(object):
+    # Bytes of message data all workers may hold in memory at once.  A
+    # single request larger than the whole budget is let through when
+    # nothing else is in flight, so it cannot block forever.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size, cancelled=None):
+        # False, without taking anything, when the cancelled event is set
+        # while waiting
+        with self._condition:
+            while self.used and self.used + size > self.limit:
+                if cancelled is not None and cancelled.is_set():
+                    return False
+                self._condition.wait(0.1)
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class ThrottledError(imaplib.IMAP4.abort):
+    # The server refused a command because of rate or connection limits
+    pass
+
+
+class Throttle(object):
+    # Adaptive rate controller for the commands sent to one host.  Throttle
+    # responses double the pause between commands and halve the number of commands
+    # in flight; a run of quick successes undoes that step by step, and
+    # latency well above what a command type usually takes slows down the
+    # pace a little before the server starts refusing.
+
+    ramp_up = 20
+    latency_factor = 4
+    max_delay = 30.0
+
+    def __init__(self):
+        self.delay = 0.0
+        self.limit = 0  # commands in flight, 0 for no limit
+        self.active = 0
+        self.peak = 0
+        self.failures = 0
+        self._successes = 0
+        self._next_start = 0.0
+        self._latency = {}
+        self._baseline = {}
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self.limit and self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, *exc):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def success(self, name=None, elapsed=0.0):
+        with self._condition:
+            latency = self._slow(name, elapsed) if name is not None else 0
+            if latency:
+                # Pace commands, but never slower than one per round trip
+                self.delay = min(max(self.delay * 1.5, 0.05), latency, self.max_delay)
+                self._successes = 0
+                return
+            self._successes += 1
+            if self._successes < self.ramp_up:
+                return
+            self._successes = 0
+            self.delay = self.delay / 2 if self.delay > 0.01 else 0.0
+            if self.limit:
+                self.limit += 1
+                if self.limit > self.peak:
+                    self.limit = 0
+                self._condition.notify_all()
+
+    def _slow(self, name, elapsed):
+        # Track a moving average of the latency of each command type and
+        # return it when it is well above the best average seen so far
+        latency = self._latency.get(name)
+        latency = elapsed if latency is None else 0.8 * latency + 0.2 * elapsed
+        self._latency[name] = latency
+        baseline = min(self._baseline.get(name, latency), latency)
+        self._baseline[name] = baseline
+        if latency > self.latency_factor * max(baseline, 0.05):
+            return latency
+        return 0
+
+    def failure(self):
+        with self._condition:
+            self.failures += 1
+            self._successes = 0
+            self.delay = min(max(self.delay * 2, 0.5), self.max_delay)
+            self.limit = max((self.limit or self.active) // 2, 1)
+
+
+def uid_set(uids):
+    # Compact a list of UIDs into an IMAP sequence set, e.g. "1:4,7,9:10"
+    uids = sorted(uids)
+    ranges = []
+    start = end = uids[0]
+    for uid in uids[1:]:
+        if uid == end + 1:
+            end = uid
+            continue
+        ranges.append(str(start) if start == end else '%d:%d' % (start, end))
+        start = end = uid
+    ranges.append(str(start) if start == end else '%d:%d' % (start, end))
+    return ','.join(ranges)
+
+
+def expand_uid_set(text):
+    # Inverse of uid_set, keeping the order of the set as given
+    uids = []
+    for part in text.split(','):
+        first, _, last = part.partition(':')
+        first = int(first)
+        last = int(last or first)
+        step = 1 if last >= first else -1
+        uids.extend(range(first, last + step, step))
+    return uids
+
+
+def make_batches(records, batch_size, batch_bytes):
+    # Group planned messages by count and by cumulative RFC822.SIZE.  A single
+    # message bigger than batch_bytes still gets a batch of its own.
+    batch = []
+    batch_total = 0
+    for record in records:
+        size = record['size'] or 0
+        if batch and (len(batch) >= batch_size or batch_total + size > batch_bytes):
+            yield batch
+            batch = []
+            batch_total = 0
+        batch.append(record)
+        batch_total += size
+    if batch:
+        yield batch
+
+
+def prefetch(iterable, depth=2, stop=None, discard=None):
+    # Run a generator in a background thread so the next items are being
+    # produced while the caller consumes the current one.  The stop event
+    # is set once the caller is gone; discard() is called for every item
+    # produced but never consumed.
+    items = queue.Queue(depth)
+    stop = stop if stop is not None else threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    if discard is not None:
+                        discard(item)
+                    # Let the generator clean up what it still holds
+                    iterable.close()
+                    return
+        except BaseException as e:
+            put((None, e))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        # Make sure the producer is idle before the caller reuses whatever
+        # connection it was reading from, handing back what it queued
+        # meanwhile so it is not left waiting for resources forever.
+        stop.set()
+        while thread.is_alive() or not items.empty():
+            try:
+                item, error = items.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if discard is not None and error is None and item is not done:
+                discard(item)
+        thread.join()
+
+
+def _parse_flat(data, index, pos):
+    # Fast path for the usual FETCH response: pairs of attribute and value
+    # without nested lists.  Returns the record and the index of the next
+    # item, or None when the message needs the full tokenizer.
+    record = {'uid': None, 'size': None, 'flags': None, 'internaldate': None, 'literal': None}
+    for index in range(index, len(data)):
+        line = data[index]
+        literal = None
+        if isinstance(line, tuple):
+            line, literal = line
+        elif line == b')':
+            return record, index + 1
+        match = _fetch_attributes_re.fullmatch(line, pos)
+        if match is None:
+            return None
+        # Every value group matches something non-empty when it matches
+        for name, atom, flat, quoted, literal_size in _fetch_attribute_re.findall(line, pos):
+            if atom:
+                if name == b'UID':
+                    record['uid'] = int(atom)
+                elif name == b'RFC822.SIZE':
+                    record['size'] = int(atom)
+                else:
+                    set_fetch_attribute(record, name, None if atom == b'NIL' else atom)
+            elif flat:
+                if name == b'FLAGS':
+                    record['flags'] = clean_flags(flat[1:-1])
+                else:
+                    set_fetch_attribute(record, name, flat[1:-1])
+            elif literal_size:
+                set_fetch_attribute(record, name, literal)
+            elif name == b'INTERNALDATE':
+                # Records keep INTERNALDATE quoted, as APPEND wants it
+                record['internaldate'] = quoted.decode('ascii')
+            else:
+                quoted = quoted[1:-1]
+                set_fetch_attribute(record, name, _quoted_pair_re.sub(rb'\1', quoted) if b'\\' in quoted else quoted)
+        if match.group(1):
+            return record, index + 1
+        pos = 0
+    return record, len(data)
+
+
+def _parse_tokens(data, index, pos):
+    # Token by token parser for any FETCH response, with nested lists
+    stack = [[]]
+    for index in range(index, len(data)):
+        line = data[index]
+        literal = None
+        if isinstance(line, tuple):
+            line, literal = line
+        for match in _fetch_token_re.finditer(line, pos):
+            kind = match.lastindex
+            if kind == 1:
+                stack.append([])
+            elif kind == 2:
+                items = stack.pop()
+                if not stack:
+                    return items, index + 1
+                stack[-1].append(items)
+            elif kind == 3:
+                quoted = match.group(3)
+                stack[-1].append(_quoted_pair_re.sub(rb'\1', quoted) if b'\\' in quoted else quoted)
+            elif kind == 4:
+                stack[-1].append(literal)
+            else:
+                atom = match.group(5)
+                stack[-1].append(None if atom == b'NIL' else atom)
+        pos = 0
+    return stack[0], len(data)
+
+
+def parse_fetch(data):
+    # Turn an imaplib FETCH result into one record per message.  imaplib
+    # hands over the lines of the response with every literal split off
+    # into a (line, literal) tuple; the lines are parsed in place and the
+    # literals are taken over as they are, so a message body (or its
+    # Spool) is never copied.  Several messages per response, attributes
+    # in any order and literals anywhere in a message are fine.
+    records = []
+    data = [item for item in data if isinstance(item, (bytes, tuple))]
+    index = 0
+    while index < len(data):
+        item = data[index]
+        match = _fetch_start_re.match(item[0] if isinstance(item, tuple) else item)
+        if match is None:
+            # Anything between messages, e.g. untagged responses imaplib
+            # filed under FETCH, is ignored
+            index += 1
+            continue
+        parsed = _parse_flat(data, index, match.end())
+        if parsed is None:
+            items, index = _parse_tokens(data, index, match.end())
+            parsed = fetch_record(items), index
+        record, index = parsed
+        records.append(record)
+    return records
+
+
+def fetch_record(items):
+    # Record of one message from its list of FETCH attributes and values
+    record = {'uid': None, 'size': None, 'flags': None, 'internaldate': None, 'literal': None}
+    for i in range(0, len(items) - 1, 2):
+        if isinstance(items[i], bytes):
+            set_fetch_attribute(record, items[i], items[i + 1])
+    return record
+
+
+def set_fetch_attribute(record, name, value):
+    # Lists are either parsed into a Python list or, when flat, passed as
+    # the bytes between the parentheses
+    name = name.upper()
+    if name == b'UID':
+        record['uid'] = int(value)
+    elif name == b'RFC822.SIZE':
+        record['size'] = int(value)
+    elif name == b'FLAGS':
+        if isinstance(value, list):
+            value = b' '.join(value)
+        if value is not None:
+            record['flags'] = clean_flags(value)
+    elif name == b'INTERNALDATE':
+        if value is not None:
+            record['internaldate'] = '"%s"' % value.decode('ascii')
+    elif record['literal'] is None and name.startswith((b'BODY[', b'BODY.PEEK[', b'RFC822', b'BINARY[')):
+        record['literal'] = value
+
+
+class ConnectionStats(object):
+    # Round trips and bytes of one IMAP connection.  A connection is only
+    # used by one thread at a time, so the counters need no lock.
+
+    def __init__(self, name, target):
+        self.name = name
+        self.target = target
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Bytes on the wire, only counted separately once the connection
+        # is compressed and until then the same as bytes_in and bytes_out
+        self.compressed = False
+        self.wire_in = 0
+        self.wire_out = 0
+
+    def start_compression(self):
+        self.compressed = True
+        self.wire_in = self.bytes_in
+        self.wire_out = self.bytes_out
+
+    def snapshot(self):
+        return {'name': self.name, 'target': self.target, 'commands': self.commands,
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'compressed': self.compressed,
+                'wire_in': self.wire_in if self.compressed else self.bytes_in,
+                'wire_out': self.wire_out if self.compressed else self.bytes_out}
+
+
+def parse_status(data):
+    # Turn the untagged STATUS responses of STATUS or LIST-STATUS into
+    # {folder: {'MESSAGES': n, ...}}.  Folder names sent as literals come
+    # as a tuple followed by the attribute list.
+    result = {}
+    name = None
+    for item in data:
+        if isinstance(item, tuple):
+            name = item[1].decode('utf-8', 'replace')
+            continue
+        if item is None:
+            continue
+        match = _status_re.match(item.strip())
+        if not match:
+            continue
+        if name is None:
+            quoted, atom, _ = match.groups()
+            if quoted is not None:
+                name = re.sub(rb'\\(.)', rb'\1', quoted).decode('utf-8', 'replace')
+            else:
+                name = atom.decode('utf-8', 'replace')
+        result[name] = dict((key.decode('ascii'), int(value))
+                            for key, value in _status_item_re.findall(match.group(3)))
+        name = None
+    return result
+
+
+def quote_folder(name):
+    # Quote a folder name for use as an IMAP astring
+    if name.startswith('"') and name.endswith('"') and len(name) > 1:
+        return name
+    return '"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def unquote_folder(name):
+    if name.startswith('"') and name.endswith('"') and len(name) > 1:
+        return re.sub(r'\\(.)', r'\1', name[1:-1])
+    return name
+
+
+def decode_folder(name):
+    # Decode a folder name from the modified UTF-7 of RFC 3501
+    def decode(match):
+        chunk = match.group(1)
+        if not chunk:
+            return '&'
+        chunk = chunk.replace(',', '/') + '=' * (-len(chunk) % 4)
+        try:
+            return base64.b64decode(chunk).decode('utf-16-be')
+        except ValueError:
+            return match.group(0)
+    return _mutf7_re.sub(decode, name)
+
+
+def encode_folder(name):
+    # Encode a folder name into the modified UTF-7 of RFC 3501
+    out = []
+    pending = []
+
+    def flush():
+        if pending:
+            chunk = base64.b64encode(''.join(pending).encode('utf-16-be')).decode('ascii')
+            out.append('&' + chunk.rstrip('=').replace('/', ',') + '-')
+            del pending[:]
+
+    for char in name:
+        if 0x20 <= ord(char) <= 0x7e:
+            flush()
+            out.append('&-' if char == '&' else char)
+        else:
+            pending.append(char)
+    flush()
+    return ''.join(out)
+
+
+def parse_list(data):
+    # Turn an imaplib LIST result into (flags, delimiter, name) tuples.
+    # Names sent as literals come as a tuple of the line and the name.
+    entries = []
+    for item in data:
+        literal = None
+        if isinstance(item, tuple):
+            item, literal = item
+        if not item:
+            continue
+        match = _list_re.match(item)
+        if not match:
+            continue
+        flags = tuple(flag.decode('ascii', 'replace').lower() for flag in match.group(1).split())
+        delimiter = match.group(2)
+        if delimiter is not None:
+            delimiter = re.sub(rb'\\(.)', rb'\1', delimiter).decode('ascii', 'replace')
+        if literal is not None:
+            name = literal.decode('utf-8', 'replace')
+        else:
+            name = unquote_folder(match.group(3).strip().decode('utf-8', 'replace'))
+        entries.append((flags, delimiter, name))
+    return entries
+
+
+class FolderTree(object):
+    # The folders of one server as listed once per run, with the STATUS
+    # items LIST-STATUS returned along with them.  Names are kept as the
+    # server sends them (modified UTF-7); find() also accepts the decoded
+    # names users type on the command line.
+
+    def __init__(self, entries, status=None):
+        self.folders = {}
+        self.delimiter = None
+        status = status or {}
+        for flags, delimiter, name in entries:
+            if name.upper() == 'INBOX':
+                name = 'INBOX'
+            self.folders[name] = {'flags': flags, 'status': status.get(name)}
+            if self.delimiter is None and delimiter:
+                self.delimiter = delimiter
+        if self.delimiter is None:
+            self.delimiter = '/'
+        self._decoded = dict((decode_folder(name), name) for name in self.folders)
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def add(self, name):
+        name = unquote_folder(name)
+        self.folders.setdefault(name, {'flags': (), 'status': None})
+        self._decoded[decode_folder(name)] = name
+
+    def find(self, name):
+        # Name of a folder as the server knows it, or None
+        name = unquote_folder(name)
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        if name in self.folders:
+            return name
+        return self._decoded.get(name)
+
+    def names(self, selectable=True):
+        return sorted(name for name in self.folders if not selectable or self.selectable(name))
+
+    def selectable(self, name):
+        flags = self.folders[name]['flags']
+        return '\\noselect' not in flags and '\\nonexistent' not in flags
+
+    def top_level(self):
+        # Folders without a parent, including ones that cannot be selected
+        return [name for name in self.names(selectable=False) if self.delimiter not in name]
+
+    def children(self, name):
+        # Every selectable folder below name, parents first
+        prefix = unquote_folder(name) + self.delimiter
+        return [child for child in self.names() if child.startswith(prefix)]
+
+    def status(self, name):
+        name = self.find(name)
+        return self.folders[name]['status'] if name is not None else None
+
+
+class MigrationStats(object):
+    # Counters shared by all worker threads of one migration, including
+    # the time spent in each phase summed over all threads and the
+    # traffic of every connection opened
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.processed = 0  # Counter for total messages processed
+        self.copied = 0  # Counter for total messages copied
+        self.copied_bytes = 0
+        self.no_message_id = 0
+        self.cached = 0  # Counter for mails appended from the cache
+        self.phases = dict((name, [0.0, 0]) for name in PHASES)
+        self.lanes = {}  # size class -> [messages, bytes, seconds]
+        self.connections = []
+
+    def add(self, processed=0, copied=0, copied_bytes=0, no_message_id=0, lane=None, cached=0):
+        with self._lock:
+            self.processed += processed
+            self.copied += copied
+            self.copied_bytes += copied_bytes
+            self.no_message_id += no_message_id
+            self.cached += cached
+            if lane is not None:
+                totals = self.lanes.setdefault(lane, [0, 0, 0.0])
+                totals[0] += copied
+                totals[1] += copied_bytes
+
+    def lane_time(self, lane, seconds):
+        # Wall-clock time a lane spent copying, summed over its connections
+        with self._lock:
+            self.lanes.setdefault(lane, [0, 0, 0.0])[2] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                totals = self.phases[name]
+                totals[0] += elapsed
+                totals[1] += 1
+
+    def connection(self, target):
+        with self._lock:
+            number = sum(1 for c in self.connections if c.target == target) + 1
+            connection = ConnectionStats('%s-%d' % (target, number), target)
+            self.connections.append(connection)
+        return connection
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time.time() - self.started
+            phases = dict((name, {'seconds': round(seconds, 6), 'count': count})
+                          for name, (seconds, count) in self.phases.items())
+            connections = [c.snapshot() for c in self.connections]
+            lanes = dict((name, {'copied': copied, 'copied_bytes': copied_bytes, 'seconds': round(seconds, 3),
+                                 'bytes_per_sec': round(copied_bytes / seconds, 1) if seconds else 0.0})
+                         for name, (copied, copied_bytes, seconds) in self.lanes.items())
+            snapshot = {'elapsed': round(elapsed, 3), 'processed': self.processed,
+                        'copied': self.copied, 'copied_bytes': self.copied_bytes,
+                        'no_message_id': self.no_message_id, 'cached': self.cached,
+                        'messages_per_sec': round(self.copied / elapsed, 3) if elapsed else 0.0,
+                        'bytes_per_sec': round(self.copied_bytes / elapsed, 1) if elapsed else 0.0,
+                        'phases': phases, 'lanes': lanes}
+        targets = {}
+        for connection in connections:
+            totals = targets.setdefault(connection['target'], {
+                'connections': 0, 'commands': 0, 'bytes_in': 0, 'bytes_out': 0,
+                'wire_in': 0, 'wire_out': 0})
+            totals['connections'] += 1
+            for key in ('commands', 'bytes_in', 'bytes_out', 'wire_in', 'wire_out'):
+                totals[key] += connection[key]
+        snapshot['targets'] = targets
+        snapshot['connections'] = connections
+        return snapshot
+
+
+class MetricsReporter(object):
+    # Periodically append a JSON line with the migration statistics to a
+    # file and/or rewrite a Prometheus textfile, plus a final summary.
+
+    def __init__(self, stats, path=None, prometheus=None, interval=METRICS_INTERVAL):
+        self.stats = stats
+        self.path = path
+        self.prometheus = prometheus
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.path or self.prometheus:
+            self._thread = threading.Thread(target=self._run, name="IMAP_Copy-metrics", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        # Stop reporting progress and write the end-of-run summary
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.report('summary')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report('progress')
+
+    def report(self, event):
+        snapshot = self.stats.snapshot()
+        if event != 'summary':
+            # Per-connection counters only go into the summary
+            del snapshot['connections']
+        if self.path:
+            line = json.dumps(dict(time=time.strftime('%Y-%m-%dT%H:%M:%S%z'), event=event, **snapshot))
+            if self.path == '-':
+                sys.stdout.write(line + '\n')
+                sys.stdout.flush()
+            else:
+                with open(self.path, 'a') as f:
+                    f.write(line + '\n')
+        if self.prometheus:
+            self._write_prometheus(snapshot)
+        return snapshot
+
+    def _write_prometheus(self, snapshot):
+        # Write to a temporary file first so node_exporter never reads a
+        # half-written file
+        lines = [
+            '# TYPE imapcopy_messages_processed_total counter',
+            'imapcopy_messages_processed_total %d' % snapshot['processed'],
+            '# TYPE imapcopy_messages_copied_total counter',
+            'imapcopy_messages_copied_total %d' % snapshot['copied'],
+            '# TYPE imapcopy_bytes_copied_total counter',
+            'imapcopy_bytes_copied_total %d' % snapshot['copied_bytes'],
+            '# TYPE imapcopy_messages_cached_total counter',
+            'imapcopy_messages_cached_total %d' % snapshot['cached'],
+            '# TYPE imapcopy_phase_seconds_total counter',
+        ]
+        for name, phase in sorted(snapshot['phases'].items()):
+            lines.append('imapcopy_phase_seconds_total{phase="%s"} %f' % (name, phase['seconds']))
+        lines.append('# TYPE imapcopy_phase_calls_total counter')
+        for name, phase in sorted(snapshot['phases'].items()):
+            lines.append('imapcopy_phase_calls_total{phase="%s"} %d' % (name, phase['count']))
+        lines.append('# TYPE imapcopy_lane_messages_total counter')
+        for name, lane in sorted(snapshot['lanes'].items()):
+            lines.append('imapcopy_lane_messages_total{lane="%s"} %d' % (name, lane['copied']))
+        lines.append('# TYPE imapcopy_lane_bytes_total counter')
+        for name, lane in sorted(snapshot['lanes'].items()):
+            lines.append('imapcopy_lane_bytes_total{lane="%s"} %d' % (name, lane['copied_bytes']))
+        lines.append('# TYPE imapcopy_lane_seconds_total counter')
+        for name, lane in sorted(snapshot['lanes'].items()):
+            lines.append('imapcopy_lane_seconds_total{lane="%s"} %f' % (name, lane['seconds']))
+        lines.append('# TYPE imapcopy_commands_total counter')
+        for target, totals in sorted(snapshot['targets'].items()):
+            lines.append('imapcopy_commands_total{target="%s"} %d' % (target, totals['commands']))
+        lines.append('# TYPE imapcopy_connection_bytes_total counter')
+        for target, totals in sorted(snapshot['targets'].items()):
+            lines.append('imapcopy_connection_bytes_total{target="%s",direction="in"} %d' % (
+                target, totals['bytes_in']))
+            lines.append('imapcopy_connection_bytes_total{target="%s",direction="out"} %d' % (
+                target, totals['bytes_out']))
+        lines.append('# TYPE imapcopy_wire_bytes_total counter')
+        for target, totals in sorted(snapshot['targets'].items()):
+            lines.append('imapcopy_wire_bytes_total{target="%s",direction="in"} %d' % (
+                target, totals['wire_in']))
+            lines.append('imapcopy_wire_bytes_total{target="%s",direction="out"} %d' % (
+                target, totals['wire_out']))
+        lines.append('# TYPE imapcopy_connections_total counter')
+        for target, totals in sorted(snapshot['targets'].items()):
+            lines.append('imapcopy_connections_total{target="%s"} %d' % (target, totals['connections']))
+        temporary = self.prometheus + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temporary, self.prometheus)
+
+
+class SyncState(object):
+    # Local SQLite record of every source message that has been copied to
+    # (or was found in) a destination folder, keyed by source account,
+    # folder, UIDVALIDITY and UID and by the destination account (target)
+    # and folder, so one database can serve several destinations.
+
+    def __init__(self, path, target=''):
+        self.target = target
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]
+        if columns and 'target' not in columns:
+            # Written by a version that didn't know the destination, the
+            # next run rebuilds it from the destination folders
+            self._db.execute("DROP TABLE messages")
+            self._db.execute("DROP TABLE IF EXISTS folders")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS messages (
+            account TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            target TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            uidvalidity INTEGER NOT NULL,
+            uid INTEGER NOT NULL,
+            destination_uid INTEGER,
+            sha1 TEXT,
+            message_id TEXT,
+            copied_at REAL,
+            PRIMARY KEY (account, folder, target, destination, uidvalidity, uid))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS folders (
+            account TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            target TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            uidvalidity INTEGER NOT NULL,
+            highestmodseq INTEGER,
+            PRIMARY KEY (account, folder, target, destination))""")
+        self._db.commit()
+
+    def known_uids(self, account, folder, destination, uidvalidity):
+        # UIDs of folder already handled.  Rows left from an older
+        # UIDVALIDITY no longer describe the folder and are dropped.
+        key = (account, folder, self.target, destination, uidvalidity)
+        with self._lock:
+            self._db.execute("DELETE FROM messages WHERE account = ? AND folder = ? AND target = ? "
+                             "AND destination = ? AND uidvalidity != ?", key)
+            self._db.commit()
+            rows = self._db.execute("SELECT uid FROM messages WHERE account = ? AND folder = ? AND target = ? "
+                                    "AND destination = ? AND uidvalidity = ?", key)
+            return set(row[0] for row in rows)
+
+    def record(self, account, folder, destination, uidvalidity, uid,
+               destination_uid=None, sha1=None, message_id=None):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (account, folder, self.target, destination, uidvalidity, uid,
+                              destination_uid, sha1, message_id, time.time()))
+            self._pending += 1
+            if self._pending >= 100:
+                self._db.commit()
+                self._pending = 0
+
+    def destinations(self, account, folder, destination, uidvalidity, uids):
+        # Map source UIDs to (destination UID, Message-ID)
+        result = {}
+        uids = list(uids)
+        with self._lock:
+            for i in range(0, len(uids), 500):
+                chunk = uids[i:i + 500]
+                rows = self._db.execute(
+                    "SELECT uid, destination_uid, message_id FROM messages "
+                    "WHERE account = ? AND folder = ? AND target = ? AND destination = ? AND uidvalidity = ? "
+                    "AND uid IN (%s)" % ','.join('?' * len(chunk)),
+                    [account, folder, self.target, destination, uidvalidity] + chunk)
+                for uid, destination_uid, message_id in rows:
+                    result[uid] = (destination_uid, message_id)
+        return result
+
+    def set_destination_uid(self, account, folder, destination, uidvalidity, uid, destination_uid):
+        with self._lock:
+            self._db.execute("UPDATE messages SET destination_uid = ? "
+                             "WHERE account = ? AND folder = ? AND target = ? AND destination = ? "
+                             "AND uidvalidity = ? AND uid = ?",
+                             (destination_uid, account, folder, self.target, destination, uidvalidity, uid))
+
+    def forget(self, account, folder, destination, uidvalidity, uids):
+        uids = list(uids)
+        with self._lock:
+            for i in range(0, len(uids), 500):
+                chunk = uids[i:i + 500]
+                self._db.execute(
+                    "DELETE FROM messages WHERE account = ? AND folder = ? AND target = ? AND destination = ? "
+                    "AND uidvalidity = ? AND uid IN (%s)" % ','.join('?' * len(chunk)),
+                    [account, folder, self.target, destination, uidvalidity] + chunk)
+            self._db.commit()
+
+    def folder_modseq(self, account, folder, destination, uidvalidity):
+        # HIGHESTMODSEQ of the folder at the end of the last complete run
+        # to this destination
+        with self._lock:
+            row = self._db.execute("SELECT highestmodseq FROM folders "
+                                   "WHERE account = ? AND folder = ? AND target = ? AND destination = ? "
+                                   "AND uidvalidity = ?",
+                                   (account, folder, self.target, destination, uidvalidity)).fetchone()
+        return row[0] if row else None
+
+    def set_folder_modseq(self, account, folder, destination, uidvalidity, highestmodseq):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?)",
+                             (account, folder, self.target, destination, uidvalidity, highestmodseq))
+            self._db.commit()
+            self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+class MessageCache(object):
+    # Message bodies fetched from a source, kept in a directory so another
+    # run (to a second destination, or a retry of the same one) appends
+    # them without downloading them again.  Bodies are stored once per
+    # SHA-1 digest under objects/; an SQLite index maps account, folder,
+    # UIDVALIDITY and UID to the digest, flags and internal date.  Once the
+    # bodies exceed max_size the least recently used ones are evicted.
+
+    def __init__(self, path, max_size=0):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pending = 0
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(path, 'index.sqlite'), timeout=60, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS messages (
+            account TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            uidvalidity INTEGER NOT NULL,
+            uid INTEGER NOT NULL,
+            sha1 TEXT NOT NULL,
+            flags TEXT,
+            internaldate TEXT,
+            PRIMARY KEY (account, folder, uidvalidity, uid))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_sha1 ON messages (sha1)")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS bodies (
+            sha1 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            used_at REAL NOT NULL)""")
+        self._db.commit()
+        self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+        if max_size and self.size > max_size:
+            self._evict()
+
+    def _file(self, sha1):
+        return os.path.join(self.path, 'objects', sha1[:2], sha1[2:])
+
+    def lookup(self, account, folder, uidvalidity, uids):
+        # Map the cached UIDs to (sha1, size, flags, internaldate) and mark
+        # their bodies as used
+        result = {}
+        uids = list(uids)
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(uids), 500):
+                chunk = uids[i:i + 500]
+                rows = self._db.execute(
+                    "SELECT m.uid, m.sha1, b.size, m.flags, m.internaldate "
+                    "FROM messages m JOIN bodies b ON b.sha1 = m.sha1 "
+                    "WHERE m.account = ? AND m.folder = ? AND m.uidvalidity = ? "
+                    "AND m.uid IN (%s)" % ','.join('?' * len(chunk)),
+                    [account, folder, uidvalidity] + chunk)
+                for uid, sha1, size, flags, internaldate in rows:
+                    result[uid] = (sha1, size, flags, internaldate)
+            for sha1 in set(entry[0] for entry in result.values()):
+                self._db.execute("UPDATE bodies SET used_at = ? WHERE sha1 = ?", (now, sha1))
+        return result
+
+    def open(self, sha1, size, spool_threshold):
+        # The cached body as bytes, or as a Spool reading from the cache
+        # when it is bigger than spool_threshold.  None when the file is
+        # gone or damaged.
+        try:
+            f = open(self._file(sha1), 'rb')
+        except OSError:
+            return None
+        if os.fstat(f.fileno()).st_size != size:
+            f.close()
+            return None
+        if spool_threshold and size > spool_threshold:
+            return Spool(size, f, sha1)
+        with f:
+            message = f.read()
+        if hashlib.sha1(message).hexdigest() != sha1:
+            return None
+        return message
+
+    def store(self, account, folder, uidvalidity, uid, sha1, message, flags, internaldate):
+        path = self._file(sha1)
+        with self._lock:
+            known = self._db.execute("SELECT 1 FROM bodies WHERE sha1 = ?", (sha1,)).fetchone()
+        if not known or not os.path.exists(path):
+            # Write to a temporary name first so no other run ever opens a
+            # half-written body
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+            with open(temporary, 'wb') as f:
+                for chunk in (message.chunks() if isinstance(message, Spool) else (message,)):
+                    f.write(chunk)
+            os.replace(temporary, path)
+        with self._lock:
+            if not known:
+                self.size += len(message)
+            self._db.execute("INSERT OR REPLACE INTO bodies VALUES (?, ?, ?)", (sha1, len(message), time.time()))
+            self._db.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (account, folder, uidvalidity, uid, sha1, flags, internaldate))
+            self._pending += 1
+            if self.max_size and self.size > self.max_size:
+                self._evict()
+            elif self._pending >= 100:
+                self._db.commit()
+                self._pending = 0
+
+    def _evict(self):
+        # Drop the least recently used bodies until the cache is at 90% of
+        # max_size, so not every store has to evict.  Other runs may share
+        # the directory, so the size is read from the index again.
+        self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+        target = self.max_size * 0.9
+        rows = self._db.execute("SELECT sha1, size FROM bodies ORDER BY used_at").fetchall()
+        for sha1, size in rows:
+            if self.size <= target:
+                break
+            self._db.execute("DELETE FROM messages WHERE sha1 = ?", (sha1,))
+            self._db.execute("DELETE FROM bodies WHERE sha1 = ?", (sha1,))
+            try:
+                os.remove(self._file(sha1))
+            except OSError:
+                pass
+            self.size -= size
+        self._db.commit()
+        self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+class FolderCopy(object):
+    # Everything the threads copying one source folder share
+
+    def __init__(self, source, destination, destination_count, mail_count, uidvalidity=None):
+        self.source = source
+        self.destination = destination
+        self.destination_count = destination_count
+        # How often each Message-ID (or fingerprint) occurs in the
+        # destination folder, loaded once there is something to compare
+        # against
+        self.index = collections.Counter()
+        self.mail_count = mail_count
+        self.uidvalidity = uidvalidity
+        # Folder names as stored in the sync state, without IMAP quoting
+        self.name = source.strip('"')
+        self.destination_name = destination.strip('"')
+        # Source UIDs copied by earlier attempts of this run, and whether
+        # this is such a retry
+        self.confirmed = set()
+        self.resumed = False
+        # Whether the last plan looked at every mail of the folder
+        self.scanned = False
+
+
 class IMAP_Copy(object):
     source = {
         'host': 'localhost',
@@ -41,12 +1378,23 @@ class IMAP_Copy(object):
 
     def __init__(self, source_server, destination_server, folder_mapping,
                  source_auth=(), destination_auth=(), create_folders=False,
-                 recurse=False, skip=0, limit=0, skip_folders=None):
+                 recurse=False, skip=0, limit=0, skip_folders=None,
+                 batch_size=BATCH_SIZE, batch_bytes=BATCH_BYTES,
+                 workers=1, max_conn_per_host=0, shard_threshold=0, max_shards=4,
+                 state_db=None, incremental=False, sync_deletions=False,
+                 max_memory=0, spool_threshold=SPOOL_THRESHOLD,
+                 server_side=False, move=False, timeout=TIMEOUT, retries=RETRIES,
+                 max_backoff=MAX_BACKOFF, metrics=None, prometheus=None,
+                 metrics_interval=METRICS_INTERVAL, compress=True,
+                 large_message=LARGE_MESSAGE, large_timeout=LARGE_TIMEOUT,
+                 cache=None, cache_size=0):
 
         self.logger = logging.getLogger("IMAP_Copy")
 
-        self.source.update(source_server)
-        self.destination.update(destination_server)
+        # Fresh dicts per instance, the class defaults must not pick up the
+        # port of an earlier migration in the same process
+        self.source = dict(IMAP_Copy.source, **source_server)
+        self.destination = dict(IMAP_Copy.destination, **destination_server)
         self.source_auth = source_auth
         self.destination_auth = destination_auth
 
@@ -56,63 +1404,230 @@ class IMAP_Copy(object):
         self.skip = skip
         self.limit = limit
 
-        self.total_processed = 0  # Counter for total messages processed
-        self.total_copied = 0  # Counter for total messages copied
+        # Limits for each batched UID FETCH of message bodies
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+
+        self.stats = MigrationStats()
         # List of folders to skip
         self.skip_folders = skip_folders if skip_folders is not None else []
 
         self.recurse = recurse
 
-        
-    def _connect(self, target):
+        # Message-IDs already present in each destination folder
+        self._destination_index = {}
+
+        # Folder tree of each server, listed once per run
+        self._trees = {}
+        self._trees_lock = threading.Lock()
+
+        # Every worker thread owns one source and one destination connection
+        self.workers = workers
+        self._local = threading.local()
+        self._host_slots = {}
+        if max_conn_per_host > 0:
+            for host in set([self.source['host'], self.destination['host']]):
+                # A worker needs one connection per target on that host
+                needed = [self.source['host'], self.destination['host']].count(host)
+                if max_conn_per_host < needed:
+                    self.logger.warning("--max-conn-per-host %d is too low for %s, using %d" % (
+                        max_conn_per_host, host, needed))
+                self._host_slots[host] = threading.BoundedSemaphore(max(max_conn_per_host, needed))
+                self.workers = min(self.workers, max(max_conn_per_host // needed, 1))
+
+        # Folders with at least shard_threshold mails to copy are split into
+        # up to max_shards UID ranges copied on separate connections
+        self.shard_threshold = shard_threshold
+        self.max_shards = max_shards
+
+        # Optional record of copied messages for incremental re-runs
+        if source_auth:
+            self.account = '%s@%s' % (source_auth[0], self.source['host'])
+        else:
+            self.account = self.source['host']
+        if destination_auth:
+            target = '%s@%s' % (destination_auth[0], self.destination['host'])
+        else:
+            target = self.destination['host']
+        self.state = SyncState(state_db, target) if state_db else None
+
+        # Use CONDSTORE/QRESYNC to only look at what changed since the last
+        # run, propagating flag changes and optionally expunges
+        self.incremental = incremental
+        self.sync_deletions = sync_deletions
+
+        # Messages above spool_threshold go to temporary files, and all
+        # in-flight message data is kept within max_memory bytes
+        self.spool_threshold = spool_threshold
+        self.memory = MemoryBudget(max_memory) if max_memory > 0 else None
+
+        # When both sides are the same account messages are copied (or
+        # moved) by the server instead of through this client
+        same_account = (self.source['host'].lower() == self.destination['host'].lower() and
+                        self.source.get('port') == self.destination.get('port') and
+                        bool(source_auth) and source_auth[:1] == destination_auth[:1])
+        self.server_side = server_side or move or same_account
+        self.move = move
+        if same_account and not server_side:
+            self.logger.info("Source and destination are the same account, copying on the server")
+
+        # Dropped or throttled connections are reopened with exponential
+        # backoff and the folder resumes after the mails already copied
+        self.timeout = timeout
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self._checkpoints = {}
+        self._throttles = {}
+        for host in set([self.source['host'], self.destination['host']]):
+            self._throttles[host] = Throttle()
+        self.failed_folders = []
+
+        # Messages of at least large_message bytes are copied one per FETCH
+        # with a longer timeout, on their own connection pair where the
+        # host limits allow, while the small ones go ahead
+        self.large_message = large_message
+        self.large_timeout = large_timeout
+
+        # Use COMPRESS=DEFLATE on every connection whose server offers it
+        self.compress = compress
+
+        # Optional local copy of fetched messages, appended from instead of
+        # downloading them again
+        self.cache = MessageCache(cache, cache_size) if cache else None
+
+        # Progress records as JSON lines and/or a Prometheus textfile
+        self.reporter = MetricsReporter(self.stats, metrics, prometheus, metrics_interval)
+        # Folder listings and --test results go to stdout, unless the metrics
+        # are written there
+        self.output = sys.stderr if metrics == '-' else sys.stdout
+
+    @property
+    def total_processed(self):
+        return self.stats.processed
+
+    @property
+    def total_copied(self):
+        return self.stats.copied
+
+    @property
+    def _conn_source(self):
+        return getattr(self._local, 'source', None)
+
+    @property
+    def _conn_destination(self):
+        return getattr(self._local, 'destination', None)
+
+    def _reserve(self, target, blocking=False):
+        # Take one connection slot on the host of target
+        slots = self._host_slots.get(getattr(self, target)['host'])
+        return slots is None or slots.acquire(blocking)
+
+    def _release(self, target):
+        slots = self._host_slots.get(getattr(self, target)['host'])
+        if slots is not None:
+            slots.release()
+
+    def _open(self, target, reserved=False):
         data = getattr(self, target)
         auth = getattr(self, target + "_auth")
 
-        self.logger.info("Connect to %s (%s)" % (target, data['host']))
-        if data['port'] == 993:
-            connection = imaplib.IMAP4_SSL(data['host'], data['port'])
-        else:
-            connection = imaplib.IMAP4(data['host'], data['port'])
-
-        if len(auth) > 0:
-            self.logger.info("Authenticate at %s" % target)
-            connection.login(*auth)
+        if not reserved:
+            self._reserve(target, blocking=True)
 
-        setattr(self, '_conn_%s' % target, connection)
-        self.logger.info("%s connection established" % target)
-        # Detecting delimiter on destination server
-        code, folder_list = connection.list()
-
-        folder_name_list = []
-        email_counts = []
-        
-        for box in folder_list:
-            parts = box.decode('utf-8').split('"')
-            if len(parts) == 5:
-                folder_name_list.append(parts[3].strip())
-            elif len(parts) == 3:
-                folder_name_list.append(parts[2].strip())
+        try:
+            self.logger.info("Connect to %s (%s)" % (target, data['host']))
+            if data['port'] == 993:
+                connection = IMAP4_SSL(data['host'], data['port'], timeout=self.timeout or None)
             else:
-                continue
-
-
-        folder_names = ', '.join(folder_name_list)
-        # self.logger.info("%s has the following folders: %s" % (target, folder_names))
-
-        self.delimiter = folder_list[0].split(b'"')[1]
-
-        return connection, folder_name_list
+                connection = IMAP4(data['host'], data['port'], timeout=self.timeout or None)
+            connection.spool_threshold = self.spool_threshold
+            connection.throttle = self._throttles[data['host']]
+            connection.metrics = self.stats.connection(target)
+
+            if len(auth) > 0:
+                self.logger.info("Authenticate at %s" % target)
+                connection.login(*auth)
+                # Many servers only announce their extensions after login
+                status, data = connection.capability()
+                if status == 'OK' and data[-1]:
+                    connection.capabilities = tuple(data[-1].decode('ascii').upper().split())
+
+            if self.compress and 'COMPRESS=DEFLATE' in connection.capabilities:
+                try:
+                    connection.compress()
+                    self.logger.info("Compression enabled for %s" % target)
+                except imaplib.IMAP4.error as e:
+                    self.logger.warning("Failed to enable compression on %s: %s" % (target, e))
+
+            if target == 'source' and self.incremental:
+                self._enable_condstore(connection)
+        except BaseException:
+            self._release(target)
+            raise
+
+        setattr(self._local, target, connection)
+        self.logger.info("%s connection established" % target)
+        return connection
+
+    def _enable_condstore(self, connection):
+        # Ask the source to report HIGHESTMODSEQ on SELECT and accept
+        # CHANGEDSINCE, preferring QRESYNC which also reports expunges.
+        for extension in ('QRESYNC', 'CONDSTORE'):
+            if extension in connection.capabilities and 'ENABLE' in connection.capabilities:
+                try:
+                    connection.enable(extension)
+                    return
+                except imaplib.IMAP4.error as e:
+                    self.logger.warning("Failed to enable %s on source: %s" % (extension, e))
+        if 'CONDSTORE' not in connection.capabilities:
+            self.logger.warning("Source server does not support CONDSTORE, every folder will be scanned")
+
+    def _list_folders(self, connection):
+        # One LIST for the whole server, returning the STATUS of every
+        # folder along with it where LIST-STATUS is supported
+        status = {}
+        if 'LIST-STATUS' in connection.capabilities:
+            items = STATUS_ITEMS
+            if 'STATUS=SIZE' in connection.capabilities:
+                items = items[:-1] + ' SIZE)'
+            try:
+                typ, data = connection._simple_command('LIST', '""', '"*"', 'RETURN', '(STATUS %s)' % items)
+                typ, data = connection._untagged_response(typ, data, 'LIST')
+                status = parse_status(connection.response('STATUS')[1])
+            except imaplib.IMAP4.error as e:
+                self.logger.warning("LIST-STATUS failed, falling back to LIST: %s" % e)
+                typ, data = connection.list()
+        else:
+            typ, data = connection.list()
+        if typ != 'OK':
+            raise imaplib.IMAP4.error("Failed to list folders: %s" % data)
+        return FolderTree(parse_list(data), status)
+
+    def _folder_tree(self, target):
+        # Folder tree of a server, listed on this thread's connection the
+        # first time it is needed
+        with self._trees_lock:
+            tree = self._trees.get(target)
+            if tree is None:
+                tree = self._list_folders(getattr(self._local, target))
+                self._trees[target] = tree
+            return tree
 
+    def _connect(self, target):
+        connection = self._open(target)
+        tree = self._folder_tree(target)
+        self.delimiter = tree.delimiter
+        return connection, tree.names(selectable=False)
 
-    def connect(self, test=False):
+    def connect(self, test=False, deep=False):
         src_mail, src_folders = self._connect('source')
         dest_mail, dest_folders = self._connect('destination')
         # src_folders and dest_folders are lists (array) of folder names
 
         # Check if the source and destination servers have the same number of folders
         
-        print(f"{CYAN}Source folders:{RESET}", src_folders)  # Debugging print statement
-        print(f"{CYAN}Destination folders:{RESET}", dest_folders)  # Debugging print statement
+        print(f"{CYAN}Source folders:{RESET}", [decode_folder(f) for f in src_folders], file=self.output)
+        print(f"{CYAN}Destination folders:{RESET}", [decode_folder(f) for f in dest_folders], file=self.output)
         
         src_set = set(src_folders)
         dest_set = set(dest_folders)
@@ -121,33 +1636,7 @@ class IMAP_Copy(object):
         src_folders.sort()
 
         if test:
-            # Check if the source folders and destination folders have the same number of emails
-            for folder in src_folders:
-                if folder in dest_folders:
-                    # Properly quote the folder name
-                    quoted_folder = f'"{folder}"'
-                    src_status, _ = src_mail.select(quoted_folder)
-                    dest_status, _ = dest_mail.select(quoted_folder)
-                    
-                    if src_status == 'OK' and dest_status == 'OK':
-                        src_status, src_data = src_mail.search(None, 'ALL')
-                        dest_status, dest_data = dest_mail.search(None, 'ALL')
-                        
-                        if src_status == 'OK' and dest_status == 'OK':
-                            src_email_count = len(src_data[0].split())
-                            dest_email_count = len(dest_data[0].split())
-                            
-                            if src_email_count != dest_email_count:
-                                print(f"{YELLOW}Folder '{folder}' has different number of emails:{RESET}")
-                                print(f"{RED}Source:{RESET} {src_email_count} emails")
-                                print(f"{RED}Destination:{RESET} {dest_email_count} emails")
-                            else:
-                                print(f"{GREEN}Folder '{folder}' has the same number of emails in both source and destination:{RESET} {src_email_count} emails")
-                        else:
-                            print(f"{RED}Error searching emails in folder '{folder}'{RESET}")
-                    else:
-                        print(f"{RED}Error selecting folder '{folder}'{RESET}")
-
+            clean = self.verify(src_folders, dest_folders, deep)
 
         # Output the number of folders in the source and destination
         # print(f"{CYAN}Number of folders in source:{RESET}", len(src_folders))  # Debugging print statement
@@ -157,58 +1646,828 @@ class IMAP_Copy(object):
         only_in_dest = dest_set - src_set
         
         if only_in_src:
-            print(f"{RED}Folders only in source:{RESET}")
-            for folder in only_in_src:
-                # self.logger.info('"%s" "%s"' % (folder, folder))
-                print(f'{GREEN}"{folder}" "{folder}"{RESET}')  # Added print statement for debugging
+            print(f"{RED}Folders only in source:{RESET}", file=self.output)
+            for folder in sorted(only_in_src):
+                folder = decode_folder(folder)
+                print(f'{GREEN}"{folder}" "{folder}"{RESET}', file=self.output)
         
         if only_in_dest:
-            print(f"{RED}Folders only in destination:{RESET}")
-            for folder in only_in_dest:
-                # self.logger.info('"%s" "%s"' % (folder, folder))
-                print(f'{GREEN}"{folder}" "{folder}"{RESET}')  # Added print statement for debugging
+            print(f"{RED}Folders only in destination:{RESET}", file=self.output)
+            for folder in sorted(only_in_dest):
+                folder = decode_folder(folder)
+                print(f'{GREEN}"{folder}" "{folder}"{RESET}', file=self.output)
+
+        if test:
+            # Without a folder mapping every source folder should exist in
+            # the destination
+            return clean and (bool(self.folder_mapping) or not only_in_src)
+
+
 
+    def _folder_status(self, target, folders):
+        # MESSAGES, UIDNEXT and UIDVALIDITY of the given folders, as listed
+        # with LIST-STATUS or with one STATUS per folder otherwise
+        tree = self._folder_tree(target)
+        connection = getattr(self._local, target)
+        status = {}
+        for folder in folders:
+            status[folder] = tree.status(folder)
+            if status[folder] is not None:
+                continue
+            with self.stats.phase('search'):
+                typ, data = connection.status(quote_folder(folder), STATUS_ITEMS)
+            if typ == 'OK' and data[0]:
+                status[folder] = list(parse_status(data).values())[0]
+        return status
+
+    def _resolve(self, target, name):
+        # Server name of a folder given by the user, which may be quoted or
+        # typed in plain Unicode instead of modified UTF-7
+        name = unquote_folder(name)
+        return self._folder_tree(target).find(name) or encode_folder(name)
+
+    def _message_keys(self, connection, folder, result):
+        # Map every message of a folder to its Message-ID (or its fingerprint
+        # when it has none) and store {key: [(uid, size), ...]} in result
+        keys = {}
+        try:
+            parser = email.parser.BytesHeaderParser()
+            with self.stats.phase('select'):
+                typ, data = connection.select(quote_folder(folder), True)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error("Couldn't open folder %s: %s" % (folder, data))
+            for record in self._fetch_all(connection, folder, int(data[0] or 0), VERIFY_ITEMS):
+                key, has_message_id = self._message_key(parser, record)
+                keys.setdefault(key, []).append((record['uid'], record['size']))
+            result.append(keys)
+        except BaseException as e:
+            result.append(e)
+
+    def _verify_folder(self, source_folder, destination_folder):
+        # Download Message-IDs and sizes of both folders at the same time and
+        # return the source UIDs missing from the destination, destination
+        # UIDs of extra copies and messages whose size differs
+        source_result = []
+        destination_result = []
+        thread = threading.Thread(target=self._message_keys,
+                                  args=(self._conn_destination, destination_folder, destination_result),
+                                  name="%s-verify" % threading.current_thread().name)
+        thread.start()
+        try:
+            self._message_keys(self._conn_source, source_folder, source_result)
+        finally:
+            thread.join()
+        for result in source_result + destination_result:
+            if isinstance(result, BaseException):
+                raise result
+        source_keys, destination_keys = source_result[0], destination_result[0]
+
+        missing, extra, resized = [], [], []
+        with self.stats.phase('duplicate_check'):
+            for key, messages in source_keys.items():
+                copies = destination_keys.get(key, [])
+                missing.extend(uid for uid, size in messages[len(copies):])
+                extra.extend(uid for uid, size in copies[len(messages):])
+                if copies and messages[0][1] != copies[0][1]:
+                    resized.append((key, messages[0][1], copies[0][1]))
+            for key, copies in destination_keys.items():
+                if key not in source_keys:
+                    extra.extend(uid for uid, size in copies)
+        return sorted(missing), sorted(extra), resized
+
+    def verify(self, src_folders, dest_folders, deep=False):
+        # Compare the mapped folders (or every folder present on both sides)
+        # with STATUS first and, for a deep verification, message by
+        # message.  Returns True when no difference was found.
+        pairs = [(self._resolve('source', s), self._resolve('destination', d)) for s, d in self.folder_mapping]
+        if not pairs:
+            destination_tree = self._folder_tree('destination')
+            pairs = [(folder, folder) for folder in self._folder_tree('source').names()
+                     if folder in destination_tree and destination_tree.selectable(destination_tree.find(folder))]
+        source_status = self._folder_status('source', [s for s, d in pairs])
+        destination_status = self._folder_status('destination', [d for s, d in pairs])
+
+        clean = True
+        for source_name, destination_name in pairs:
+            src = source_status.get(source_name)
+            dest = destination_status.get(destination_name)
+            source_folder, destination_folder = decode_folder(source_name), decode_folder(destination_name)
+            if src is None or dest is None:
+                clean = False
+                print(f"{RED}Error reading the status of folder '{source_folder}'{RESET}", file=self.output)
+                continue
+            src_email_count, dest_email_count = src.get('MESSAGES', 0), dest.get('MESSAGES', 0)
+            if not deep or (src_email_count == 0 and dest_email_count == 0):
+                if src_email_count != dest_email_count:
+                    clean = False
+                    print(f"{YELLOW}Folder '{source_folder}' has different number of emails:{RESET} "
+                          f"{src_email_count} in source, {dest_email_count} in destination", file=self.output)
+                else:
+                    print(f"{GREEN}Folder '{source_folder}' has the same number of emails in both "
+                          f"source and destination:{RESET} {src_email_count} emails", file=self.output)
+                continue
 
+            try:
+                missing, extra, resized = self._verify_folder(source_name, destination_name)
+            except imaplib.IMAP4.error as e:
+                clean = False
+                print(f"{RED}Error verifying folder '{source_folder}': {e}{RESET}", file=self.output)
+                continue
+            if not (missing or extra or resized):
+                print(f"{GREEN}Folder '{source_folder}' is complete:{RESET} {src_email_count} emails",
+                      file=self.output)
+                continue
+            clean = False
+            print(f"{YELLOW}Folder '{source_folder}' differs from '{destination_folder}':{RESET} "
+                  f"{len(missing)} missing, {len(extra)} extra or duplicated, {len(resized)} with a different size",
+                  file=self.output)
+            if missing:
+                print(f"{RED}  Missing source UIDs:{RESET} {uid_set(missing)}", file=self.output)
+            if extra:
+                print(f"{RED}  Extra destination UIDs:{RESET} {uid_set(extra)}", file=self.output)
+            for message_id, src_size, dest_size in resized:
+                print(f"{RED}  Size differs:{RESET} {message_id} ({src_size} in source, {dest_size} in destination)",
+                      file=self.output)
+        return clean
 
     def _disconnect(self, target):
-        if not hasattr(self, '_conn_%s' % target):
+        connection = getattr(self._local, target, None)
+        if connection is None:
             return
 
-        connection = getattr(self, '_conn_%s' % target)
-        if connection.state == 'SELECTED':
-            connection.close()
-            self.logger.info("Close folder on %s" % target)
+        setattr(self._local, target, None)
+        try:
+            if connection.state == 'SELECTED':
+                connection.close()
+                self.logger.info("Close folder on %s" % target)
 
-        self.logger.info("Disconnect from %s server" % target)
-        connection.logout()
-        delattr(self, '_conn_%s' % target)
+            self.logger.info("Disconnect from %s server" % target)
+            connection.logout()
+        finally:
+            self._release(target)
 
     def disconnect(self):
         self._disconnect('source')
         self._disconnect('destination')
 
+    def _abandon(self):
+        # Drop this thread's connections after an error without talking to
+        # the servers again
+        for target in ('source', 'destination'):
+            connection = getattr(self._local, target, None)
+            if connection is None:
+                continue
+            setattr(self._local, target, None)
+            try:
+                connection.shutdown()
+            except OSError:
+                pass
+            finally:
+                self._release(target)
+
+    def _fetch_all(self, connection, folder, message_count, items):
+        # FETCH the given items for every message of the selected folder,
+        # listing the UIDs that actually exist first so sparse folders cost
+        # no more round trips than dense ones
+        uids = self._search_uids(connection, message_count)
+        return self._fetch_uids(connection, folder, uids, items)
+
+    def _fetch_uids(self, connection, folder, uids, items):
+        # FETCH the given items for an explicit list of UIDs.  A failed
+        # chunk raises, a partial listing must never pass for the folder.
+        for i in range(0, len(uids), INDEX_CHUNK_SIZE):
+            with self.stats.phase('fetch'):
+                status, data = connection.uid('FETCH', uid_set(uids[i:i + INDEX_CHUNK_SIZE]), items)
+            if status != 'OK':
+                raise imaplib.IMAP4.error("Failed to fetch %s from folder %s: %s" % (items, folder, data))
+            with self.stats.phase('parse'):
+                records = parse_fetch(data)
+            for record in records:
+                yield record
+
+    def _search_uids(self, connection, message_count):
+        # List the UIDs of the selected folder.  The folder is walked in
+        # windows of message sequence numbers, which unlike UIDs have no
+        # gaps, so no single response line grows beyond what imaplib
+        # accepts.  A failed window fails the whole listing, callers take
+        # missing UIDs as not there.
+        uids = []
+        for first in range(1, message_count + 1, SEARCH_CHUNK_SIZE):
+            last = min(first + SEARCH_CHUNK_SIZE - 1, message_count)
+            with self.stats.phase('search'):
+                status, data = connection.uid('SEARCH', None, '%d:%d' % (first, last))
+            if status != 'OK':
+                raise imaplib.IMAP4.error("Failed to list messages %d:%d: %s" % (first, last, data))
+            if data[0]:
+                uids.extend(int(uid) for uid in data[0].split())
+        return uids
+
+    def _memory_charge(self, record):
+        # Memory a message occupies while in flight, spooled messages only
+        # ever hold one chunk
+        size = record['size'] or 0
+        if self.spool_threshold and size > self.spool_threshold:
+            return SPOOL_CHUNK_SIZE
+        return size
+
+    def _fetch_batches(self, connection, folder, plan, batch_size, batch_bytes, stop=None):
+        # Download the bodies of the planned messages one UID FETCH per batch
+        # and yield (record, message) pairs in plan order.  With a memory
+        # budget each record carries its 'charge', released by the consumer.
+        # Messages found in the cache are taken from there and marked
+        # 'cached'.  Waiting for memory ends when the stop event is set.
+        for batch in make_batches(plan, batch_size, batch_bytes):
+            if self.memory is not None:
+                charges = [self._memory_charge(record) for record in batch]
+                if not self.memory.acquire(sum(charges), stop):
+                    return
+                for record, charge in zip(batch, charges):
+                    record['charge'] = charge
+            pending = list(batch)
+            bodies = {}
+            try:
+                if self.cache is not None and folder.uidvalidity:
+                    bodies = self._cached_bodies(folder, batch)
+                missing = [r['uid'] for r in batch if r['uid'] not in bodies]
+                status = 'OK'
+                if missing:
+                    with self.stats.phase('fetch'):
+                        status, data = connection.uid('FETCH', uid_set(missing), '(BODY.PEEK[])')
+                    if status == 'OK':
+                        with self.stats.phase('parse'):
+                            for fetched in parse_fetch(data):
+                                if fetched['uid'] is not None and fetched['literal'] is not None:
+                                    bodies[fetched['uid']] = fetched['literal']
+                    del data
+                while pending:
+                    record = pending.pop(0)
+                    message = bodies.pop(record['uid'], None)
+                    if message is None:
+                        self.logger.error("Failed to fetch mail UID %d from %s: %s" % (
+                            record['uid'], folder.source, 'missing from response' if status == 'OK' else status))
+                        self._release_memory(record)
+                        continue
+                    yield record, message
+            finally:
+                # Records never handed to the consumer give their memory back
+                for record in pending:
+                    self._release_memory(record)
+                for message in bodies.values():
+                    if isinstance(message, Spool):
+                        message.close()
+
+    def _cached_bodies(self, folder, batch):
+        # Bodies of the batch the cache holds, by UID
+        bodies = {}
+        hits = self.cache.lookup(self.account, folder.name, folder.uidvalidity, [r['uid'] for r in batch])
+        for record in batch:
+            hit = hits.get(record['uid'])
+            if hit is None:
+                continue
+            sha1, size, flags, internaldate = hit
+            message = self.cache.open(sha1, size, self.spool_threshold)
+            if message is None:
+                continue
+            record['cached'] = True
+            if record['internaldate'] is None:
+                record['internaldate'] = internaldate
+            if record['flags'] is None:
+                record['flags'] = flags
+            bodies[record['uid']] = message
+        return bodies
+
+    def _message_key(self, parser, record):
+        # Cleaned Message-ID of a scanned mail, or its fingerprint when it
+        # has none, and whether the key is a Message-ID
+        headers = None
+        if record['literal']:
+            with self.stats.phase('parse'):
+                headers = parser.parsebytes(record['literal'])
+        message_id = headers['Message-ID'] if headers is not None else None
+        if message_id:
+            return clean_message_id(message_id), True
+        return message_fingerprint(headers, record['size'], record['internaldate']), False
+
+    def _load_destination_index(self, destination_folder, message_count):
+        # Fetch every Message-ID of the selected destination folder once so
+        # the duplicate check is a local lookup instead of a SEARCH per mail.
+        # Mails without one are indexed by their fingerprint.  Keys are
+        # counted, identical mails may legitimately occur several times.
+        index = collections.Counter()
+        if message_count == 0:
+            self._destination_index[destination_folder] = index
+            return index
+
+        connection = self._conn_destination
+        parser = email.parser.BytesHeaderParser()
+        for record in self._fetch_all(connection, destination_folder, message_count, INDEX_ITEMS):
+            key, has_message_id = self._message_key(parser, record)
+            index[key] += 1
+        # Only a complete index is kept for the duplicate check
+        self._destination_index[destination_folder] = index
+
+        self.logger.info("Indexed %d mails in destination folder %s" % (len(index), destination_folder))
+        return index
+
+    def _plan(self, folder, skip, uids=None):
+        # Scan headers, sizes, flags and dates of the source folder and
+        # return the messages that actually need to be downloaded.  With a
+        # sync state only UIDs it does not know yet are scanned, uids
+        # restricts the scan to an explicit list.
+        connection = self._conn_source
+        parser = email.parser.BytesHeaderParser()
+        records = []
+        known = set()
+        if self.state is not None and folder.uidvalidity and uids is None:
+            known = self.state.known_uids(self.account, folder.name, folder.destination_name, folder.uidvalidity)
+        # The scan only counts as complete when every mail of the folder was
+        # listed and every listed mail was fetched
+        folder.scanned = True
+        if uids is not None:
+            records = list(self._fetch_uids(connection, folder.source, uids, PLAN_ITEMS))
+        elif folder.mail_count > 0:
+            listed = self._search_uids(connection, folder.mail_count)
+            folder.scanned = len(listed) == folder.mail_count
+            uids = [uid for uid in listed if uid not in known]
+            records = list(self._fetch_uids(connection, folder.source, uids, PLAN_ITEMS))
+            if known:
+                self.logger.info("%d mails in %s already copied according to the sync state" % (
+                    folder.mail_count - len(records), folder.source))
+        if uids and not set(uids) <= set(record['uid'] for record in records):
+            folder.scanned = False
+        if not folder.scanned:
+            self.logger.warning("Not every mail of %s could be scanned, the next run looks at it again" % (
+                folder.source))
+        mail_count = folder.mail_count
+        destination_folder = folder.destination
+        if records:
+            # A retry indexes the destination again: an APPEND the server
+            # completed just before the connection dropped is never confirmed
+            destination_index = self._destination_index.get(destination_folder)
+            if destination_index is None or folder.resumed:
+                destination_index = self._load_destination_index(destination_folder,
+                                                                 folder.destination_count)
+            folder.index = destination_index
+
+        # A mail is only a duplicate when the destination already holds
+        # as many copies of its key as the source has up to this mail, the
+        # same comparison the deep verification makes
+        plan = []
+        seen = collections.Counter()
+        if not folder.resumed:
+            self.stats.add(processed=mail_count)
+        for progress_count, record in enumerate(records, 1):
+            if progress_count <= skip:
+                self.logger.debug("Skipping mail %d of %d" % (
+                    progress_count, len(records)))
+                continue
+
+            record['position'] = progress_count
+            key, has_message_id = self._message_key(parser, record)
+            if record['uid'] in folder.confirmed:
+                # Copied by an earlier attempt, so one of the copies found
+                seen[key] += 1
+                continue
+            record['literal'] = None
+            record['key'] = key
+            record['message_id'] = key if has_message_id else None
+
+            if has_message_id:
+                self.logger.debug(f"{CYAN}Message-ID:{RESET} {BOLD}{key}{RESET}")
+            else:
+                self.logger.debug(f"{YELLOW}Message{RESET} {BOLD} {record['uid']} {YELLOW} has no Message-ID, "
+                                  f"matching it by {key}{RESET}")
+                self.stats.add(no_message_id=1)
+
+            # Check if the message already exists in the destination folder
+            with self.stats.phase('duplicate_check'):
+                seen[key] += 1
+                duplicate = seen[key] <= destination_index[key]
+            if duplicate:
+                self.logger.debug("Mail %s already exists in destination folder %s" % (key, destination_folder))
+                if self.state is not None and folder.uidvalidity:
+                    self.state.record(self.account, folder.name, folder.destination_name, folder.uidvalidity,
+                                      record['uid'], message_id=record['message_id'])
+                continue
+
+            plan.append(record)
+
+        return plan
+
+    def _find_destination_uid(self, message_id):
+        # Look a single message up by Message-ID in the selected destination
+        # folder, used when the sync state has no destination UID for it.
+        quoted = '"%s"' % message_id.replace('\\', '\\\\').replace('"', '\\"')
+        with self.stats.phase('search'):
+            status, data = self._conn_destination.uid('SEARCH', None, 'HEADER', 'Message-ID', quoted)
+        if status != 'OK' or not data[0]:
+            return None
+        return int(data[0].split()[0])
+
+    def _destination_uids(self, folder, uids):
+        # Destination UIDs of copied source messages, from the sync state or
+        # by searching for their Message-ID.  Returns {source uid: (uid, id)}
+        result = {}
+        rows = self.state.destinations(self.account, folder.name, folder.destination_name, folder.uidvalidity, uids)
+        for uid, (destination_uid, message_id) in rows.items():
+            if destination_uid is None and message_id:
+                destination_uid = self._find_destination_uid(message_id)
+                if destination_uid is not None:
+                    self.state.set_destination_uid(self.account, folder.name, folder.destination_name,
+                                                   folder.uidvalidity, uid, destination_uid)
+            if destination_uid is not None:
+                result[uid] = (destination_uid, message_id)
+        return result
+
+    def _push_flags(self, folder, changes):
+        # Apply the current source flags to the already copied messages,
+        # one UID STORE per distinct set of flags.
+        destination_uids = self._destination_uids(folder, list(changes))
+        by_flags = {}
+        for uid, flags in changes.items():
+            if uid not in destination_uids:
+                self.logger.debug("No destination mail for UID %d in %s, flags not updated" % (uid, folder.source))
+                continue
+            by_flags.setdefault(flags or '()', []).append(destination_uids[uid][0])
+
+        updated = 0
+        for flags, uids in by_flags.items():
+            for i in range(0, len(uids), INDEX_CHUNK_SIZE):
+                chunk = uids[i:i + INDEX_CHUNK_SIZE]
+                status, data = self._conn_destination.uid('STORE', uid_set(chunk), 'FLAGS.SILENT', flags)
+                if status != 'OK':
+                    self.logger.warning("Failed to update flags in %s: %s" % (folder.destination, data))
+                    continue
+                updated += len(chunk)
+        self.logger.info("Updated flags of %d mails in %s" % (updated, folder.destination))
+
+    def _push_deletions(self, folder, uids):
+        # Expunge the copies of messages that were expunged on the source
+        destination_uids = self._destination_uids(folder, uids)
+        targets = sorted(uid for uid, message_id in destination_uids.values())
+        connection = self._conn_destination
+        for i in range(0, len(targets), INDEX_CHUNK_SIZE):
+            chunk = uid_set(targets[i:i + INDEX_CHUNK_SIZE])
+            status, data = connection.uid('STORE', chunk, '+FLAGS.SILENT', '(\\Deleted)')
+            if status != 'OK':
+                self.logger.warning("Failed to delete mails in %s: %s" % (folder.destination, data))
+                return
+            if 'UIDPLUS' in connection.capabilities:
+                connection.uid('EXPUNGE', chunk)
+        if targets and 'UIDPLUS' not in connection.capabilities:
+            connection.expunge()
+
+        index = self._destination_index.get(folder.destination)
+        if index is not None:
+            for uid, message_id in destination_uids.values():
+                if index[message_id] > 0:
+                    index[message_id] -= 1
+        self.state.forget(self.account, folder.name, folder.destination_name, folder.uidvalidity, uids)
+        self.logger.info("Deleted %d mails from %s that were expunged on the source" % (
+            len(targets), folder.destination))
+
+    def _changes(self, folder, since):
+        # Use CHANGEDSINCE to find what happened to the source folder since
+        # the last complete run.  Flag changes and expunges of copied mails
+        # are applied to the destination right away; the UIDs of new mails
+        # are returned for planning.
+        connection = self._conn_source
+        qresync = 'QRESYNC' in connection.capabilities and self.sync_deletions
+        known = self.state.known_uids(self.account, folder.name, folder.destination_name, folder.uidvalidity)
+        changed = {}
+        vanished = []
+        if folder.mail_count > 0:
+            with self.stats.phase('fetch'):
+                status, data = connection.uid('FETCH', '1:*', '(UID FLAGS)',
+                                              '(CHANGEDSINCE %d%s)' % (since, ' VANISHED' if qresync else ''))
+            if status != 'OK':
+                self.logger.warning("CHANGEDSINCE failed on %s, scanning the whole folder: %s" % (folder.source, data))
+                return None
+            with self.stats.phase('parse'):
+                records = parse_fetch(data)
+            for record in records:
+                if record['uid'] is not None:
+                    changed[record['uid']] = record['flags']
+            vanished = [v for v in connection.response('VANISHED')[1] if v]
+
+        self.logger.info("%d mails in %s changed since MODSEQ %d" % (len(changed), folder.source, since))
+        flag_changes = dict((uid, flags) for uid, flags in changed.items() if uid in known)
+        if flag_changes:
+            self._push_flags(folder, flag_changes)
+
+        if self.sync_deletions and known:
+            if folder.mail_count == 0:
+                gone = known
+            elif qresync:
+                ranges = []
+                for line in vanished:
+                    for part in line.replace(b'(EARLIER)', b'').strip().split(b','):
+                        first, _, last = part.partition(b':')
+                        ranges.append((int(first), int(last or first)))
+                gone = set(uid for uid in known
+                           if any(min(a, b) <= uid <= max(a, b) for a, b in ranges))
+            else:
+                uids = self._search_uids(connection, folder.mail_count)
+                if len(uids) != folder.mail_count:
+                    # The folder changed under us, a partial listing would
+                    # make every mail it lacks look expunged
+                    self.logger.warning("Listed %d of %d mails in %s, not syncing deletions this time" % (
+                        len(uids), folder.mail_count, folder.source))
+                    uids = known
+                gone = known - set(uids)
+            if gone:
+                self._push_deletions(folder, sorted(gone))
+
+        return sorted(uid for uid in changed if uid not in known)
+
+    def _release_memory(self, record):
+        if self.memory is not None and record.get('charge'):
+            self.memory.release(record.pop('charge'))
+
+    def _discard(self, item):
+        # A fetched (record, message) pair that will never be appended
+        record, message = item
+        if isinstance(message, Spool):
+            message.close()
+        self._release_memory(record)
+
+    @contextlib.contextmanager
+    def _timeout(self, seconds):
+        # Give this thread's connections another timeout for a while
+        connections = [c for c in (self._conn_source, self._conn_destination) if c is not None]
+        previous = [c.sock.gettimeout() for c in connections]
+        for connection in connections:
+            connection.sock.settimeout(seconds or None)
+        try:
+            yield
+        finally:
+            for connection, timeout in zip(connections, previous):
+                try:
+                    connection.sock.settimeout(timeout)
+                except OSError:
+                    # The connection died meanwhile and gets replaced
+                    pass
+
+    def _copy_messages(self, folder, plan, lane='small'):
+        # Download and append the planned messages on this thread's
+        # connections, both folders must already be selected.  Large
+        # messages are fetched one at a time with the longer timeout.
+        if lane == 'large':
+            with self._timeout(self.large_timeout):
+                return self._copy_batches(folder, plan, lane, 1, self.batch_bytes)
+        return self._copy_batches(folder, plan, lane, self.batch_size, self.batch_bytes)
+
+    def _copy_batches(self, folder, plan, lane, batch_size, batch_bytes):
+        if not plan:
+            return 0
+        copy_count = 0
+        start = time.perf_counter()
+
+        # Bodies are fetched in batches on the source connection while the
+        # previous batch is being appended to the destination.
+        stop = threading.Event()
+        batches = self._fetch_batches(self._conn_source, folder, plan, batch_size, batch_bytes, stop)
+        try:
+            for record, message in prefetch(batches, stop=stop, discard=self._discard):
+                copy_count += self._append(folder, record, message, lane, copy_count)
+        finally:
+            self.stats.lane_time(lane, time.perf_counter() - start)
+        return copy_count
+
+    def _append(self, folder, record, message, lane, copy_count):
+        # Append one fetched message to the destination, 1 when it worked
+        try:
+            with self.stats.phase('append'):
+                status, data = self._conn_destination.append(
+                    folder.destination, record['flags'], record['internaldate'], message,
+                )
+            message_sha1 = message_digest(message)
+            message_size = len(message)
+            if self.cache is not None and folder.uidvalidity and not record.get('cached'):
+                self.cache.store(self.account, folder.name, folder.uidvalidity, record['uid'],
+                                 message_sha1, message, record['flags'], record['internaldate'])
+        finally:
+            if isinstance(message, Spool):
+                message.close()
+            del message
+            self._release_memory(record)
+
+        if status != 'OK':
+            self.logger.error("Failed to append mail UID %d to %s: %s" % (
+                record['uid'], folder.destination, data))
+            return 0
+
+        folder.index[record['key']] += 1
+        folder.confirmed.add(record['uid'])
+        self.stats.add(copied=1, copied_bytes=message_size, lane=lane,
+                       cached=1 if record.get('cached') else 0)
+
+        if self.state is not None and folder.uidvalidity:
+            # UIDPLUS servers report the UID of the new message
+            match = _appenduid_re.search(data[0] or b'')
+            self.state.record(self.account, folder.name, folder.destination_name, folder.uidvalidity,
+                              record['uid'], int(match.group(2)) if match else None,
+                              message_sha1, record['message_id'])
+
+        self.logger.debug("Copy mail %d of %d (copy_count=%d, sha1(message)=%s)" % (
+            record['position'], folder.mail_count, copy_count + 1, message_sha1))
+        return 1
+
+    def _copy_server_side(self, folder, plan):
+        # Let the server copy (or move) the planned messages with UID COPY /
+        # UID MOVE in bulk.  The destination folder name is resolved by the
+        # source session.  Chunks the server refuses are copied through the
+        # client instead.
+        connection = self._conn_source
+        command = 'COPY'
+        if self.move:
+            if 'MOVE' in connection.capabilities:
+                command = 'MOVE'
+            else:
+                self.logger.warning("Source server does not support MOVE, copying and expunging instead")
+
+        copy_count = 0
+        for i in range(0, len(plan), INDEX_CHUNK_SIZE):
+            chunk = plan[i:i + INDEX_CHUNK_SIZE]
+            uids = uid_set(r['uid'] for r in chunk)
+            status, data = connection.uid(command, uids, folder.destination)
+            if status != 'OK':
+                self.logger.warning("UID %s to %s failed (%s), copying through the client" % (
+                    command, folder.destination, data))
+                copy_count += self._copy_messages(folder, chunk)
+                continue
+
+            if command == 'COPY' and self.move:
+                connection.uid('STORE', uids, '+FLAGS.SILENT', '(\\Deleted)')
+                if 'UIDPLUS' in connection.capabilities:
+                    connection.uid('EXPUNGE', uids)
+                else:
+                    connection.expunge()
+
+            # UIDPLUS servers report where the messages ended up, in the
+            # tagged response for COPY and an untagged OK for MOVE
+            destination_uids = {}
+            copyuid = [d for d in data if d] + [b'COPYUID ' + d for d in connection.response('COPYUID')[1] if d]
+            for line in copyuid:
+                match = _copyuid_re.search(line)
+                if match:
+                    destination_uids.update(zip(expand_uid_set(match.group(2).decode('ascii')),
+                                                expand_uid_set(match.group(3).decode('ascii'))))
+
+            for record in chunk:
+                folder.index[record['key']] += 1
+                folder.confirmed.add(record['uid'])
+                if self.state is not None and folder.uidvalidity:
+                    self.state.record(self.account, folder.name, folder.destination_name, folder.uidvalidity,
+                                      record['uid'], destination_uids.get(record['uid']), None,
+                                      record['message_id'])
+            copy_count += len(chunk)
+            self.stats.add(copied=len(chunk))
+            self.logger.info("%s %d mails %s => %s on the server" % (
+                'Moved' if self.move else 'Copied', len(chunk), folder.source, folder.destination))
+
+        return copy_count
+
+    def _copy_shard(self, folder, shard, results, lane='small'):
+        # Copy one UID range (or the large mails) of a folder on a
+        # connection pair of its own.  The host slots for both connections
+        # were reserved by the caller.
+        try:
+            try:
+                self._open('source', reserved=True)
+            except BaseException:
+                self._release('destination')
+                raise
+            self._open('destination', reserved=True)
+            with self.stats.phase('select'):
+                status, data = self._conn_source.select(folder.source, True)
+            if status != "OK":
+                raise imaplib.IMAP4.error("Couldn't open source folder %s" % folder.source)
+            with self.stats.phase('select'):
+                status, data = self._conn_destination.select(folder.destination)
+            if status != "OK":
+                raise imaplib.IMAP4.error("Couldn't open destination folder %s" % folder.destination)
+            results.append(self._copy_messages(folder, shard, lane))
+        except BaseException as e:
+            self._abandon()
+            results.append(e)
+        finally:
+            self.disconnect()
+
+    def _copy_sharded(self, folder, plan):
+        # Split a big folder into contiguous UID ranges and copy each range
+        # on its own connection pair.  Only as many extra pairs as the
+        # per-host limits allow right now are opened; the current worker
+        # copies the first shard itself.
+        wanted = min(-(-len(plan) // self.shard_threshold), self.max_shards)
+        extra = 0
+        while extra < wanted - 1:
+            if not self._reserve('source'):
+                break
+            if not self._reserve('destination'):
+                self._release('source')
+                break
+            extra += 1
+
+        if extra == 0:
+            return self._copy_messages(folder, plan)
+
+        shard_size = -(-len(plan) // (extra + 1))
+        shards = [plan[i:i + shard_size] for i in range(0, len(plan), shard_size)]
+        self.logger.info("Copy %s => %s in %d shards of up to %d mails" % (
+            folder.source, folder.destination, len(shards), shard_size))
+
+        results = []
+        threads = []
+        for i, shard in enumerate(shards[1:], 1):
+            thread = threading.Thread(target=self._copy_shard,
+                                      args=(folder, shard, results),
+                                      name="%s-shard-%d" % (threading.current_thread().name, i))
+            thread.start()
+            threads.append(thread)
+        # Release reservations that ended up without a shard
+        for i in range(extra + 1 - len(shards)):
+            self._release('source')
+            self._release('destination')
+
+        try:
+            copy_count = self._copy_messages(folder, shards[0])
+        finally:
+            for thread in threads:
+                thread.join()
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+            copy_count += result
+        return copy_count
+
+    def _copy_lanes(self, folder, small, large):
+        # Copy the small mails while the large ones go over a connection
+        # pair of their own, so one huge attachment doesn't stall the
+        # folder.  Without a free pair for them, the large mails follow the
+        # small ones on this worker's connections.
+        results = []
+        thread = None
+        if small and self._reserve('source'):
+            if self._reserve('destination'):
+                self.logger.info("Copy %d large mails of %s on their own connections" % (
+                    len(large), folder.source))
+                thread = threading.Thread(target=self._copy_shard,
+                                          args=(folder, large, results, 'large'),
+                                          name="%s-large" % threading.current_thread().name)
+                thread.start()
+            else:
+                self._release('source')
+
+        try:
+            if self.shard_threshold > 0 and len(small) >= self.shard_threshold:
+                copy_count = self._copy_sharded(folder, small)
+            else:
+                copy_count = self._copy_messages(folder, small)
+            if thread is None:
+                copy_count += self._copy_messages(folder, large, 'large')
+        finally:
+            if thread is not None:
+                thread.join()
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+            copy_count += result
+        return copy_count
+
     def copy(self, source_folder, destination_folder, skip, limit, recurse=True):
 
         # Skip the folder if it's in the skip_folders list
-        if source_folder in self.skip_folders:
-            self.logger.info("Skipping folder %s" % source_folder)
+        if self._skipped(unquote_folder(source_folder)):
+            self.logger.info("Skipping folder %s" % decode_folder(unquote_folder(source_folder)))
             return
-            
-        # There should be no files stored in / so we are bailing out
-        if source_folder == '':
+
+        # There are no mails in the root or in folders that only hold
+        # other folders, but their sub-folders are copied
+        source_tree = self._folder_tree('source')
+        name = source_tree.find(source_folder)
+        if source_folder == '' or (name is not None and not source_tree.selectable(name)):
+            if self.recurse and recurse:
+                self._copy_children(source_folder, destination_folder, skip, limit)
             return
 
-        # Connect to source and open folder
-        status, data = self._conn_source.select(source_folder, True)
+        # Connect to source and open folder, read-only unless mails are
+        # moved away from it
+        with self.stats.phase('select'):
+            status, data = self._conn_source.select(source_folder, not self.move)
         if status != "OK":
-            self.logger.error("Couldn't open source folder %s" % source_folder)
-            sys.exit(2)
+            raise imaplib.IMAP4.error("Couldn't open source folder %s: %s" % (source_folder, data))
+        source_count = int(data[0] or 0)
+        uidvalidity = self._conn_source.response('UIDVALIDITY')[1][0]
+        highestmodseq = self._conn_source.response('HIGHESTMODSEQ')[1][0]
 
         # Connect to destination and open or create folder
-        status, data = self._conn_destination.select(destination_folder)
+        with self.stats.phase('select'):
+            status, data = self._conn_destination.select(destination_folder)
         if status != "OK" and not self.create_folders:
-            self.logger.error("Couldn't open destination folder %s" % destination_folder)
-            sys.exit(2)
+            raise imaplib.IMAP4.error("Couldn't open destination folder %s: %s" % (destination_folder, data))
         elif status != "OK":
             self.logger.info("Create destination folder %s" % destination_folder)
             status, response = self._conn_destination.create(destination_folder)
@@ -216,10 +2475,11 @@ class IMAP_Copy(object):
                 if b'ALREADYEXISTS' in response:
                     self.logger.info("Destination folder %s already exists" % destination_folder)
                 else:
-                    self.logger.error("Failed to create destination folder %s: %s" % (destination_folder, response))
-                    sys.exit(2)
+                    raise imaplib.IMAP4.error("Failed to create destination folder %s: %s" % (
+                        destination_folder, response))
             else:
                 self.logger.info("Successfully created destination folder %s" % destination_folder)
+            self._folder_tree('destination').add(destination_folder)
 
             # Subscribe to the newly created folder
             status, response = self._conn_destination.subscribe(destination_folder)
@@ -228,99 +2488,72 @@ class IMAP_Copy(object):
             else:
                 self.logger.info("Successfully subscribed to destination folder %s" % destination_folder)
 
-            status, data = self._conn_destination.select(destination_folder)
+            with self.stats.phase('select'):
+                status, data = self._conn_destination.select(destination_folder)
             if status != "OK":
-                self.logger.error("Failed to select destination folder %s: %s" % (destination_folder, data))
-                sys.exit(2)
+                raise imaplib.IMAP4.error("Failed to select destination folder %s: %s" % (destination_folder, data))
             else:
                 self.logger.info("Successfully selected destination folder %s" % destination_folder)
 
+        folder = FolderCopy(source_folder, destination_folder, int(data[0] or 0), source_count,
+                            int(uidvalidity) if uidvalidity else None)
+        # The same source folder may be copied to several destinations
+        checkpoint = (folder.name, folder.uidvalidity, unquote_folder(destination_folder))
+        folder.resumed = checkpoint in self._checkpoints
+        folder.confirmed = self._checkpoints.setdefault(checkpoint, folder.confirmed)
+        mail_count = source_count
+
+        # In incremental mode only mails changed since the last complete
+        # run are looked at
+        modseq = None
+        uids = None
+        if self.incremental and self.state is not None and folder.uidvalidity and highestmodseq:
+            modseq = int(highestmodseq)
+            since = self.state.folder_modseq(self.account, folder.name, folder.destination_name, folder.uidvalidity)
+            if since is not None and since >= modseq:
+                self.logger.info("Folder %s unchanged since the last run (HIGHESTMODSEQ %d)" % (source_folder, modseq))
+                uids = []
+            elif since is not None:
+                uids = self._changes(folder, since)
+
         # Look for mails
         self.logger.info("Looking for mail in %s" % source_folder)
-        status, data = self._conn_source.search(None, 'ALL')
-        data = data[0].split()
-        mail_count = len(data)
-
-        self.logger.info("Start copy %s => %s (%d mails)" % (source_folder, destination_folder, mail_count))
-
-        progress_count = 0
-        copy_count = 0
-
-        for msg_num in data:
-            progress_count += 1
-            self.total_processed += 1  # Increment total processed counter
-            if progress_count <= skip:
-                self.logger.info("Skipping mail %d of %d" % (
-                    progress_count, mail_count))
-                continue
-            else:
-                status, data = self._conn_source.fetch(msg_num, '(RFC822 FLAGS INTERNALDATE)')
-
-                message = data[0][1]
-                msg = email.message_from_bytes(message)
-                message_id = msg['Message-ID']
-
-                 # Properly quote the Message-ID
-                if not message_id:
-                    self.logger.warning(f"{YELLOW}Message{RESET} {BOLD} {msg_num} {YELLOW} has no Message-ID. {RED} Copying without checking for duplicates {RESET}")
-                    # Print
-                    print(f"{YELLOW}Message{RESET} {BOLD} {msg_num} {YELLOW} has no Message-ID. {RED} Copying without checking for duplicates {RESET}")
-                else:
-                    # Escape double quotes and ensure the Message-ID is properly quoted
-                    # Clean a string, remove all spaces and line breaks
-                    message_id_cleaned = message_id.replace('  ', '').replace(' ', '').replace('\n', '').replace('\r', '').replace('\\', '\\\\').replace('"', '\\"')
-
-                    self.logger.debug(f"Quoted Message-ID: {message_id_cleaned}")
-                    # Print colored Message-ID
-                    print(f"{CYAN}Message-ID:{RESET} {BOLD}{message_id}{RESET}")
-
-
-                    # Check if the message already exists in the destination folder
-                    status, dest_data = self._conn_destination.search(None, f'HEADER Message-ID "{message_id_cleaned}"')
-                    if status == "OK" and dest_data[0]:
-                        self.logger.info("Mail with Message-ID %s already exists in destination folder %s" % (message_id, destination_folder))  
-                        continue
-
-                flags_line = data[0][0].decode('ascii')
-                if flags_line.find('FLAGS') < 0 and len(data) > 1:
-                    flags_line = data[1].decode('ascii')
-
-                flags_start = flags_line.index('FLAGS (') + len('FLAGS (')
-                flags_end = flags_line.index(')', flags_start)
-
-                flags = '(' + flags_line[flags_start:flags_end] + ')'
-
-                 # Remove the \RECENT flag, the script was throwing errors when trying to copy the mail
-                flags = flags.replace('\\Recent', '').replace('\\RECENT', '').strip()
-                if flags == '()':
-                    flags = None
-
-                internaldate_start = flags_line.index('INTERNALDATE ') + len('INTERNALDATE ')
-                internaldate_end = flags_line.find(' RFC822', internaldate_start)
-                if internaldate_end < 0:
-                    internaldate_end = flags_line.find(' FLAGS', internaldate_start)
-                if internaldate_end < 0:
-                    internaldate_end = flags_line.find(')', internaldate_start)
-                if internaldate_end < 0:
-                    internaldate_end = len(flags_line)
-
-                internaldate = flags_line[internaldate_start:internaldate_end]
-
-                self._conn_destination.append(
-                    destination_folder, flags, internaldate, message,
-                )
-
-                copy_count += 1
-                self.total_copied += 1  # Increment total copied counter
-                message_sha1 = hashlib.sha1(message).hexdigest()
+        plan = self._plan(folder, skip, uids)
+        planned = len(plan)
+
+        self.logger.info("Start copy %s => %s (%d mails, %d to copy)" % (
+            source_folder, destination_folder, mail_count, len(plan)))
+
+        if limit > 0:
+            plan = plan[:max(limit - len(folder.confirmed), 0)]
+
+        large = []
+        if self.large_message > 0 and not self.server_side:
+            large = [record for record in plan if (record['size'] or 0) >= self.large_message]
+        if large:
+            plan = [record for record in plan if (record['size'] or 0) < self.large_message]
+
+        if self.server_side:
+            copy_count = self._copy_server_side(folder, plan)
+        elif large:
+            copy_count = self._copy_lanes(folder, plan, large)
+        elif self.shard_threshold > 0 and len(plan) >= self.shard_threshold:
+            copy_count = self._copy_sharded(folder, plan)
+        else:
+            copy_count = self._copy_messages(folder, plan)
 
-                self.logger.info("Copy mail %d of %d (copy_count=%d, sha1(message)=%s)" % (
-                    progress_count, mail_count, copy_count, message_sha1))
+        if self.cache is not None:
+            self.cache.flush()
+        if self.state is not None:
+            self.state.flush()
+            if modseq is not None and skip == 0 and folder.scanned and copy_count == planned:
+                # Everything up to this MODSEQ is now in the destination
+                self.state.set_folder_modseq(self.account, folder.name, folder.destination_name,
+                                             folder.uidvalidity, modseq)
 
-                if limit > 0 and copy_count >= limit:
-                    self.logger.info("Copy limit %d reached (copy_count=%d)" % (
-                        limit, copy_count))
-                    break
+        if limit > 0 and copy_count >= limit:
+            self.logger.info("Copy limit %d reached (copy_count=%d)" % (
+                limit, copy_count))
 
         self.logger.info("Copy complete %s => %s (%d out of %d messages copied)" % (
             source_folder, destination_folder, copy_count, mail_count))
@@ -330,75 +2563,479 @@ class IMAP_Copy(object):
 
 
         if self.recurse and recurse:
-            self.logger.info("Getting list of folders under %s" % source_folder)
-            connection = self._conn_source
-            typ, data = connection.list(source_folder)
-
-            # Sort the folders
-            data.sort()
-
-            for d in data:
-                if d:
-                    l_resp = d.decode('utf-8').split('"')
-                    # response = '(\HasChildren) "/" INBOX'
-                    if len(l_resp) == 3:
-
-                        source_mbox = d.decode('utf-8').split('"')[2].strip()
-                        # make sure we don't have a recursive loop
-                        if source_mbox != source_folder:
-                            # maybe better use regex to replace only start of the souce name
-                            dest_mbox = source_mbox.replace(source_folder, destination_folder)
-                            self.logger.info("starting copy of folder %s to %s " % (source_mbox, dest_mbox))
-                            self.copy(source_mbox, dest_mbox, skip, limit, False)
+            self._copy_children(source_folder, destination_folder, skip, limit)
+
+    def _copy_children(self, source_folder, destination_folder, skip, limit):
+        # Copy every folder below source_folder (all folders for the root)
+        # to the same place below destination_folder, translating the
+        # hierarchy delimiter between the servers
+        source_tree = self._folder_tree('source')
+        delimiter = self._folder_tree('destination').delimiter
+        source = unquote_folder(source_folder)
+        destination = unquote_folder(destination_folder)
+        children = source_tree.children(source) if source else source_tree.names()
+        for child in children:
+            relative = child[len(source) + len(source_tree.delimiter):] if source else child
+            relative = relative.replace(source_tree.delimiter, delimiter)
+            target = destination + delimiter + relative if destination else relative
+            self.logger.info("starting copy of folder %s to %s " % (decode_folder(child), decode_folder(target)))
+            self.copy(quote_folder(child), quote_folder(target), skip, limit, False)
+
+    def _skipped(self, folder):
+        # Folders given with --skip-folders are skipped with their sub-folders
+        delimiter = self._folder_tree('source').delimiter
+        for skipped in self.skip_folders:
+            skipped = self._resolve('source', skipped)
+            if folder == skipped or folder.startswith(skipped + delimiter):
+                return True
+        return False
+
+    def _jobs(self):
+        # Build the list of folder jobs.  Mappings that share a destination
+        # folder stay in one job so only one worker ever appends to it.
+        jobs = {}
+        for source_folder, destination_folder in self.folder_mapping:
+            if unquote_folder(source_folder):
+                source_folder = quote_folder(self._resolve('source', source_folder))
+            if unquote_folder(destination_folder):
+                destination_folder = quote_folder(self._resolve('destination', destination_folder))
+            jobs.setdefault(destination_folder, []).append((source_folder, destination_folder))
+        return list(jobs.values())
+
+    def _folder_size(self, folder):
+        # Size of a source folder as reported by LIST-STATUS or STATUS, used
+        # to schedule the largest folders first.
+        status = self._folder_tree('source').status(folder)
+        if status is not None:
+            return status.get('SIZE', status.get('MESSAGES', 0))
+        connection = self._conn_source
+        item = 'SIZE' if 'STATUS=SIZE' in connection.capabilities else 'MESSAGES'
+        try:
+            status, data = connection.status(folder, '(%s)' % item)
+        except imaplib.IMAP4.error:
+            return 0
+        if status != 'OK' or not data[0]:
+            return 0
+        match = re.search(item.encode('ascii') + rb' (\d+)', data[0])
+        return int(match.group(1)) if match else 0
+
+    def _work(self, jobs, errors, connect):
+        # Worker loop: take folder jobs until the queue is empty.  Extra
+        # workers open their own connection pair, the main thread reuses
+        # the connections opened by connect().
+        try:
+            if connect:
+                self._open('source')
+                self._open('destination')
+            while not errors:
+                try:
+                    job = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                for source_folder, destination_folder in job:
+                    self._supervise(source_folder, destination_folder)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            if connect:
+                self.disconnect()
+
+    def _supervise(self, source_folder, destination_folder):
+        # Copy one folder, reconnecting with exponential backoff when a
+        # connection drops or the server throttles us.  Each attempt skips
+        # the mails confirmed by the earlier ones.  Folders that cannot be
+        # opened are logged and skipped.
+        failures = 0
+        progress = self.total_copied
+        while True:
+            try:
+                if self._conn_source is None:
+                    self._open('source')
+                if self._conn_destination is None:
+                    self._open('destination')
+                self.copy(source_folder, destination_folder, self.skip, self.limit)
+                return
+            except (imaplib.IMAP4.abort, OSError) as e:
+                self._abandon()
+                if self.total_copied > progress:
+                    failures = 0
+                    progress = self.total_copied
+                failures += 1
+                if failures > self.retries:
+                    self.logger.error("Giving up on %s after %d attempts: %s" % (source_folder, failures, e))
+                    raise
+                delay = min(BACKOFF * 2 ** (failures - 1), self.max_backoff)
+                delay = random.uniform(delay / 2, delay)
+                self.logger.warning("Connection lost while copying %s (%s), reconnecting in %.1fs (attempt %d of %d)" % (
+                    source_folder, e, delay, failures, self.retries))
+                time.sleep(delay)
+            except imaplib.IMAP4.error as e:
+                self.logger.error("%s" % e)
+                self.failed_folders.append(source_folder)
+                return
+
+    def _log_summary(self, summary):
+        self.logger.info("Copied %d of %d mails (%d bytes) in %.1fs, %.1f mails/s" % (
+            summary['copied'], summary['processed'], summary['copied_bytes'],
+            summary['elapsed'], summary['messages_per_sec']))
+        for name in PHASES:
+            phase = summary['phases'][name]
+            if phase['count']:
+                self.logger.info("  %-16s %9.3fs in %d calls" % (name, phase['seconds'], phase['count']))
+        if 'large' in summary['lanes']:
+            for name, lane in sorted(summary['lanes'].items(), key=lambda item: item[0] != 'small'):
+                self.logger.info("  %-16s %d mails, %d bytes in %.1fs, %.0f bytes/s" % (
+                    name + ' mails', lane['copied'], lane['copied_bytes'], lane['seconds'], lane['bytes_per_sec']))
+        for target, totals in sorted(summary['targets'].items()):
+            self.logger.info("  %-16s %d connections, %d round trips, %d bytes in, %d bytes out" % (
+                target, totals['connections'], totals['commands'], totals['bytes_in'], totals['bytes_out']))
+            logical = totals['bytes_in'] + totals['bytes_out']
+            wire = totals['wire_in'] + totals['wire_out']
+            if wire != logical:
+                self.logger.info("  %-16s %d bytes in, %d bytes out on the wire, %.0f%% saved by compression" % (
+                    '', totals['wire_in'], totals['wire_out'], 100.0 * (logical - wire) / logical))
+        if summary['cached']:
+            self.logger.info("%d mails were appended from the cache instead of the source" % summary['cached'])
+        if summary['no_message_id']:
+            self.logger.info("%d mails had no Message-ID and were matched by size, date and headers" % (
+                summary['no_message_id']))
 
     def run(self):
         # print self.folder_mapping for debugging
+        self.reporter.start()
         try:
-            self.connect()  
-
-            for source_folder, destination_folder in self.folder_mapping:
-                # print for debugging
-                # print(f"{CYAN}Copying folder:{RESET} {source_folder} {CYAN}to:{RESET} {destination_folder}")
-
-                if ' ' in source_folder and '"' not in source_folder:
-                    # debbuging print statement
-                    # print(f"{RED}Source folder has a space{RESET}")
-                    source_folder = '"%s"' % source_folder
-                if ' ' in destination_folder and '"' not in destination_folder:
-                    # debbuging print statement
-                    # print(f"{RED}Destination folder has a space{RESET}")
-                    destination_folder = '"%s"' % destination_folder
-
-                # print for debugging
-                # print(f"{CYAN}Copying folder:{RESET} {source_folder} {CYAN}to:{RESET} {destination_folder}")
-                self.copy(source_folder, destination_folder, self.skip, self.limit)
+            self.connect()
+
+            if not self.folder_mapping:
+                # Without a mapping every folder is copied to the same name,
+                # only the top-level ones when recursing into sub-folders
+                source_tree = self._folder_tree('source')
+                delimiter = self._folder_tree('destination').delimiter
+                names = source_tree.top_level() if self.recurse else source_tree.names()
+                self.folder_mapping = [(decode_folder(name), decode_folder(name.replace(source_tree.delimiter, delimiter)))
+                                       for name in names]
+
+            jobs = self._jobs()
+            if self.workers > 1 and len(jobs) > 1:
+                # Schedule the largest folders first so a big folder does not
+                # start last and dominate the total run time.
+                sizes = {}
+                for job in jobs:
+                    sizes[id(job)] = sum(self._folder_size(s) for s, d in job)
+                jobs.sort(key=lambda job: sizes[id(job)], reverse=True)
+
+            pending = queue.Queue()
+            for job in jobs:
+                pending.put(job)
+
+            errors = []
+            threads = []
+            for i in range(min(self.workers, len(jobs)) - 1):
+                thread = threading.Thread(target=self._work, args=(pending, errors, True),
+                                          name="IMAP_Copy-worker-%d" % (i + 1))
+                thread.start()
+                threads.append(thread)
+            self._work(pending, errors, False)
+            for thread in threads:
+                thread.join()
+
+            if errors:
+                raise errors[0]
+        finally:
+            self.disconnect()
+            self._log_summary(self.reporter.stop())
+
+    def account_size(self):
+        # Size of the source folders this migration would copy, in the
+        # units _folder_size() uses, to schedule the accounts of a batch
+        try:
+            self._open('source')
+            tree = self._folder_tree('source')
+            folders = [self._resolve('source', source_folder)
+                       for source_folder, destination_folder in self.folder_mapping
+                       if unquote_folder(source_folder)]
+            if not folders or len(folders) < len(self.folder_mapping):
+                folders = tree.names()
+            return sum(self._folder_size(quote_folder(folder))
+                       for folder in set(folders) if not self._skipped(folder))
         finally:
             self.disconnect()
 
-    def test_connections(self):
+    def test_connections(self, deep=False):
+        # Returns False when the folders differ or a connection failed
         self.logger.info("Testing connections to source and destination")
         try:
-            self.connect(True)
-            self.logger.info("Test OK")
+            clean = self.connect(True, deep)
+            if clean:
+                self.logger.info("Test OK")
+            else:
+                self.logger.warning("Source and destination differ")
+            return clean
         except Exception as e:
             self.logger.error("Connection error: %s" % str(e))
+            return False
         finally:
             self.disconnect()
 
 
+def parse_server(value):
+    # "imap.example.com:993" -> {'host': 'imap.example.com', 'port': 993}
+    parts = value.split(':')
+    server = {'host': parts[0]}
+    if len(parts) > 1:
+        server['port'] = int(parts[1])
+    return server
+
+
+def parse_auth(value):
+    return tuple(value.split(':'))
+
+
+# Fields of an account in a batch manifest, and of its row in the report
+MANIFEST_FIELDS = ('name', 'source', 'source_auth', 'destination', 'destination_auth', 'folders', 'size')
+REPORT_FIELDS = ('name', 'status', 'source', 'destination', 'processed', 'copied', 'copied_bytes',
+                 'failed_folders', 'elapsed', 'error')
+SCHEDULES = ('largest-first', 'smallest-first', 'manifest')
+
+
+def load_manifest(path):
+    # Read the accounts of a batch from a CSV file with a header line or
+    # a JSON list of objects, both using the MANIFEST_FIELDS.  Folders
+    # are written like on the command line, alternating source and
+    # destination folder; in JSON they may also be a list of pairs.
+    with open(path, newline='') as f:
+        if path.endswith('.json'):
+            rows = json.load(f)
+            if isinstance(rows, dict):
+                rows = rows.get('accounts', [])
+        else:
+            rows = list(csv.DictReader(f))
+    accounts = []
+    names = set()
+    for number, row in enumerate(rows, 1):
+        missing = [field for field in ('source', 'source_auth', 'destination', 'destination_auth')
+                   if not row.get(field)]
+        if missing:
+            raise ValueError("account %d of %s has no %s" % (number, path, ', '.join(missing)))
+        folders = row.get('folders') or []
+        if isinstance(folders, str):
+            folders = shlex.split(folders)
+        if folders and not isinstance(folders[0], str):
+            folders = [folder for pair in folders for folder in pair]
+        if len(folders) % 2 != 0:
+            raise ValueError("account %d of %s has an odd number of folders" % (number, path))
+        source_auth = parse_auth(row['source_auth'])
+        name = row.get('name') or '%s@%s' % (source_auth[0], parse_server(row['source'])['host'])
+        if name in names:
+            raise ValueError("account %d of %s has the same name as another account: %s" % (number, path, name))
+        names.add(name)
+        size = row.get('size')
+        accounts.append({
+            'name': name,
+            'source': parse_server(row['source']),
+            'source_auth': source_auth,
+            'destination': parse_server(row['destination']),
+            'destination_auth': parse_auth(row['destination_auth']),
+            'folders': sorted(zip(folders[::2], folders[1::2])),
+            'size': int(size) if size not in (None, '') else None,
+        })
+    return accounts
+
+
+def _account_copy(account, options):
+    # IMAP_Copy for one account of a batch; paths in the options may
+    # contain {name} so that every account gets its own files
+    options = dict(options)
+    for key in ('state_db', 'metrics', 'prometheus'):
+        if options.get(key):
+            options[key] = options[key].replace('{name}', re.sub(r'[^\w.@-]', '_', account['name']))
+    return IMAP_Copy(account['source'], account['destination'], account['folders'],
+                     account['source_auth'], account['destination_auth'], **options)
+
+
+def _account_logger(account, level):
+    # Pool processes log to stderr with the account in every line
+    logger = logging.getLogger("IMAP_Copy")
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%%(asctime)s - %s - %%(levelname)s - %%(message)s' % account['name']))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return logger
+
+
+def probe_account(account, options, level=logging.WARNING):
+    # Runs in a pool process: size of the account for the schedule
+    _account_logger(account, level)
+    return _account_copy(account, options).account_size()
+
+
+def run_account(account, options, test=False, deep=False, level=logging.INFO):
+    # Runs in a pool process: migrate (or verify) one account and return
+    # its row of the batch report.  Errors end up in the row instead of
+    # stopping the batch.
+    logger = _account_logger(account, level)
+    result = {'name': account['name'], 'status': 'ok',
+              'source': '%s (%s)' % (account['source_auth'][0], account['source']['host']),
+              'destination': '%s (%s)' % (account['destination_auth'][0], account['destination']['host']),
+              'processed': 0, 'copied': 0, 'copied_bytes': 0, 'failed_folders': [], 'error': None}
+    start = time.time()
+    imap_copy = None
+    try:
+        # Folder listings go to stdout, which the processes of a batch share
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            imap_copy = _account_copy(account, options)
+            if test:
+                if not imap_copy.test_connections(deep):
+                    result['status'] = 'different'
+            else:
+                imap_copy.run()
+    except Exception as e:
+        logger.error("%s" % e)
+        result['status'] = 'error'
+        result['error'] = str(e)
+    if imap_copy is not None:
+        summary = imap_copy.stats.snapshot()
+        result.update(processed=summary['processed'], copied=summary['copied'],
+                      copied_bytes=summary['copied_bytes'])
+        result['failed_folders'] = [unquote_folder(folder) for folder in imap_copy.failed_folders]
+        if result['failed_folders'] and result['status'] == 'ok':
+            result['status'] = 'failed'
+    result['elapsed'] = round(time.time() - start, 1)
+    return result
+
+
+class BatchRunner(object):
+    # Migrates the accounts of a manifest in a pool of processes, each
+    # account with its own IMAP_Copy.  At most `jobs` accounts run at once
+    # and at most `max_per_host` of them use the same IMAP host.
+
+    def __init__(self, accounts, options, jobs=4, max_per_host=0, schedule='largest-first',
+                 test=False, deep=False, level=logging.INFO):
+        self.logger = logging.getLogger("IMAP_Copy")
+        self.accounts = accounts
+        self.options = options
+        self.jobs = jobs
+        self.max_per_host = max_per_host
+        self.schedule = schedule
+        self.test = test
+        self.deep = deep
+        self.level = level
+        self.results = []
+
+    def _hosts(self, account):
+        return set([account['source']['host'].lower(), account['destination']['host'].lower()])
+
+    def _map(self, executor, function, accounts, *args):
+        # Yield (account, future) as they complete, starting accounts in
+        # the given order as soon as their hosts have a free slot.  An
+        # account whose hosts are busy does not hold back the ones after
+        # it.
+        pending = list(accounts)
+        running = {}
+        busy = {}
+        while pending or running:
+            for account in pending[:]:
+                if len(running) >= self.jobs:
+                    break
+                hosts = self._hosts(account)
+                if self.max_per_host and any(busy.get(host, 0) >= self.max_per_host for host in hosts):
+                    continue
+                pending.remove(account)
+                for host in hosts:
+                    busy[host] = busy.get(host, 0) + 1
+                running[executor.submit(function, account, *args)] = account
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                account = running.pop(future)
+                for host in self._hosts(account):
+                    busy[host] -= 1
+                yield account, future
+
+    def _order(self, executor):
+        # Accounts in the order they are started.  Sizes missing from the
+        # manifest are taken from the source servers first.
+        accounts = list(self.accounts)
+        if self.schedule == 'manifest':
+            return accounts
+        unknown = [account for account in accounts if account['size'] is None]
+        if unknown:
+            self.logger.info("Measuring %d accounts" % len(unknown))
+        sizes = {}
+        for account, future in self._map(executor, probe_account, unknown, self.options):
+            try:
+                sizes[account['name']] = future.result()
+            except Exception as e:
+                self.logger.warning("Failed to measure %s: %s" % (account['name'], e))
+                sizes[account['name']] = 0
+        for account in accounts:
+            if account['size'] is None:
+                account['size'] = sizes[account['name']]
+        # Starting the largest accounts first keeps one big account from
+        # finishing long after all others; smallest first gets the most
+        # accounts done early
+        accounts.sort(key=lambda account: account['size'], reverse=self.schedule == 'largest-first')
+        return accounts
+
+    def run(self):
+        start = time.time()
+        # Fresh interpreters, so no pool process inherits threads, locks
+        # or connections
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(self.jobs, mp_context=context) as executor:
+            accounts = self._order(executor)
+            self.logger.info("Migrating %d accounts, %d at a time" % (len(accounts), self.jobs))
+            for account, future in self._map(executor, run_account, accounts, self.options,
+                                             self.test, self.deep, self.level):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The pool process itself died
+                    result = {'name': account['name'], 'status': 'error', 'error': str(e)}
+                self.results.append(result)
+                self.logger.info("%s: %s, %d of %d mails copied (%d/%d accounts done)" % (
+                    result['name'], result['status'], result.get('copied', 0), result.get('processed', 0),
+                    len(self.results), len(accounts)))
+        # Report the accounts in the order of the manifest
+        names = [account['name'] for account in self.accounts]
+        self.results.sort(key=lambda result: names.index(result['name']))
+        failed = [result for result in self.results if result['status'] != 'ok']
+        self.logger.info("Batch finished in %.1fs: %d accounts ok, %d not" % (
+            time.time() - start, len(self.results) - len(failed), len(failed)))
+        return not failed
+
+
+def write_report(path, results):
+    # One row per account, as JSON when the path ends with .json and as
+    # CSV otherwise
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, REPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            row = dict(result)
+            row['failed_folders'] = ' '.join(shlex.quote(folder) for folder in result.get('failed_folders') or [])
+            writer.writerow(row)
+
+
 def main():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('source',
+    parser.add_argument('source', nargs='?',
                         help="source host, e.g. imap.googlemail.com:993")
 
-    parser.add_argument('source_auth', metavar='source-auth',
+    parser.add_argument('source_auth', metavar='source-auth', nargs='?',
                         help="source host credentials, e.g. username@host.de:password")
 
-    parser.add_argument('destination',
+    parser.add_argument('destination', nargs='?',
                         help="destination host, e.g. imap.otherhoster.com:993")
 
-    parser.add_argument('destination_auth', metavar='destination-auth',
+    parser.add_argument('destination_auth', metavar='destination-auth', nargs='?',
                         help="destination host credentials, e.g. username@host.de:password")
 
     parser.add_argument('folders', type=str, nargs='*',
@@ -406,7 +3043,12 @@ def main():
 
     parser.add_argument('-t', '--test', dest='test_connections',
                         action="store_true", default=False,
-                        help="do not copy, only test connections to source and destination")
+                        help="do not copy, only test connections to source and destination and compare "
+                             "the number of mails in each folder")
+
+    parser.add_argument('--deep', action="store_true", default=False,
+                        help="with --test, compare the Message-ID and size of every mail and list the "
+                             "missing and duplicated ones")
 
     parser.add_argument('-c', '--create-folders', dest='create_folders',
                         action="store_true", default=False,
@@ -439,65 +3081,206 @@ def main():
     parser.add_argument("-l", "--limit", default=0, metavar="N", type=check_negative,
                         help="only copy at most N message(s)")
 
+    def check_positive(value):
+        ivalue = int(value)
+        if ivalue <= 0:
+            raise argparse.ArgumentTypeError("%s is an invalid positive integer value" % value)
+        return ivalue
+
+    def check_size(value):
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        multiplier = units.get(value[-1:].upper(), 1)
+        number = value[:-1] if multiplier > 1 else value
+        try:
+            ivalue = int(float(number) * multiplier)
+        except ValueError:
+            raise argparse.ArgumentTypeError("%s is an invalid size, e.g. 512K, 20M or 1G" % value)
+        if ivalue <= 0:
+            raise argparse.ArgumentTypeError("%s is an invalid positive size" % value)
+        return ivalue
+
+    def check_size_or_zero(value):
+        if value.strip() == '0':
+            return 0
+        return check_size(value)
+
+    parser.add_argument("--batch-size", default=BATCH_SIZE, metavar="N", type=check_positive,
+                        help="fetch at most N message(s) per UID FETCH (default: %(default)s)")
+
+    parser.add_argument("--batch-bytes", default=BATCH_BYTES, metavar="SIZE", type=check_size,
+                        help="fetch at most SIZE bytes per UID FETCH, e.g. 20M (default: %(default)s)")
+
+    parser.add_argument("-w", "--workers", default=1, metavar="N", type=check_positive,
+                        help="copy up to N folders in parallel, each on its own connection pair (default: %(default)s)")
+
+    parser.add_argument("--max-conn-per-host", default=0, metavar="N", type=check_negative,
+                        help="open at most N connections to any one host, 0 for no limit (default: %(default)s)")
+
+    parser.add_argument("--shard-threshold", default=0, metavar="N", type=check_negative,
+                        help="split folders with at least N mails to copy into UID ranges copied "
+                             "on separate connections, 0 to disable (default: %(default)s)")
+
+    parser.add_argument("--shards", default=4, metavar="N", type=check_positive,
+                        help="split a folder into at most N shards (default: %(default)s)")
+
+    parser.add_argument("--state-db", metavar="PATH",
+                        help="remember copied mails in the SQLite database PATH so later runs "
+                             "only look at new mails")
+
+    parser.add_argument("--incremental", action="store_true", default=False,
+                        help="use CONDSTORE/QRESYNC to only look at mails changed since the last run "
+                             "and update the flags of copied mails, requires --state-db")
+
+    parser.add_argument("--sync-deletions", action="store_true", default=False,
+                        help="with --incremental, also delete mails from the destination that were "
+                             "expunged on the source")
+
+    parser.add_argument("--max-memory", default=0, metavar="SIZE", type=check_size_or_zero,
+                        help="keep at most SIZE bytes of message data in memory across all workers, "
+                             "e.g. 256M, 0 for no limit (default: %(default)s)")
+
+    parser.add_argument("--spool-threshold", default=SPOOL_THRESHOLD, metavar="SIZE", type=check_size,
+                        help="spool messages bigger than SIZE to temporary files (default: 1M)")
+
+    parser.add_argument("--large-message", default=LARGE_MESSAGE, metavar="SIZE", type=check_size_or_zero,
+                        help="copy mails of at least SIZE bytes one at a time on a connection pair of their "
+                             "own, 0 to copy them with the others (default: 10M)")
+
+    parser.add_argument("--large-timeout", type=check_negative, default=LARGE_TIMEOUT, metavar='SECONDS',
+                        help="--timeout while copying large mails (default: %(default)s)")
+
+    parser.add_argument("--cache", metavar="DIR",
+                        help="keep fetched mails in DIR and append them from there in later runs "
+                             "instead of downloading them from the source again")
+
+    parser.add_argument("--cache-size", default=0, metavar="SIZE", type=check_size_or_zero,
+                        help="evict the least recently used mails once --cache holds more than SIZE, "
+                             "e.g. 20G, 0 for no limit (default: %(default)s)")
+
+    parser.add_argument("--server-side", action="store_true", default=False,
+                        help="copy with UID COPY on the source server, the destination folders must be "
+                             "reachable from the source account (default when both are the same account)")
+
+    parser.add_argument("--move", action="store_true", default=False,
+                        help="move mails on the source server with UID MOVE instead of copying them, "
+                             "implies --server-side")
+
+    parser.add_argument("--timeout", type=check_negative, default=TIMEOUT, metavar='SECONDS',
+                        help="consider a connection dead after SECONDS without an answer, 0 to wait forever "
+                             "(default: %(default)s)")
+
+    parser.add_argument("--retries", type=check_negative, default=RETRIES, metavar='N',
+                        help="reconnect at most N times in a row without progress before giving up "
+                             "(default: %(default)s)")
+
+    parser.add_argument("--max-backoff", type=check_positive, default=MAX_BACKOFF, metavar='SECONDS',
+                        help="longest wait between reconnect attempts (default: %(default)s)")
+
+    parser.add_argument("--metrics", metavar='PATH',
+                        help="append a JSON line with progress, per-phase timings and traffic to PATH "
+                             "every --metrics-interval seconds and a summary at the end, - for stdout")
+
+    parser.add_argument("--metrics-interval", type=check_positive, default=METRICS_INTERVAL, metavar='SECONDS',
+                        help="seconds between two progress records (default: %(default)s)")
+
+    parser.add_argument("--prometheus", metavar='PATH',
+                        help="keep the same metrics in the Prometheus textfile PATH")
+
+    parser.add_argument("--no-compress", dest='compress', action="store_false", default=True,
+                        help="don't use COMPRESS=DEFLATE even when a server supports it")
+
+    parser.add_argument("--manifest", metavar='PATH',
+                        help="migrate every account listed in the CSV or JSON file PATH instead of the "
+                             "account given on the command line")
+
+    parser.add_argument("-j", "--jobs", type=check_positive, default=4, metavar='N',
+                        help="with --manifest, migrate up to N accounts in parallel (default: %(default)s)")
+
+    parser.add_argument("--max-accounts-per-host", type=check_negative, default=0, metavar='N',
+                        help="with --manifest, migrate at most N accounts at once on any one host, "
+                             "0 for no limit (default: %(default)s)")
+
+    parser.add_argument("--schedule", choices=SCHEDULES, default='largest-first',
+                        help="with --manifest, order in which accounts are started (default: %(default)s)")
+
+    parser.add_argument("--report", metavar='PATH',
+                        help="with --manifest, write the result of every account to PATH, as JSON when "
+                             "PATH ends with .json and as CSV otherwise")
+
     args = parser.parse_args()
 
-    _source = args.source.split(':')
-    source = {'host': _source[0]}
-    if len(_source) > 1:
-        source['port'] = int(_source[1])
-
-    _destination = args.destination.split(':')
-    destination = {'host': _destination[0]}
-    if len(_destination) > 1:
-        destination['port'] = int(_destination[1])
-
-    source_auth = tuple(args.source_auth.split(':'))
-    destination_auth = tuple(args.destination_auth.split(':'))
-
-    if not args.test_connections:
-        if len(args.folders) == 0:
-            # If no specific folders are provided, copy all folders
-            source_conn = imaplib.IMAP4_SSL(source['host'], source['port'])
-            source_conn.login(*source_auth)
-            status, folders = source_conn.list()
-            if status != "OK":
-                print("Failed to retrieve folders from source")
-                sys.exit(1)
-            args.folders = []
-            for folder in folders:
-                parts = folder.decode('utf-8').split('"')
-                if len(parts) == 5:
-                    args.folders.append(parts[3].strip())
-                    args.folders.append(parts[3].strip())
-                elif len(parts) == 3:
-                    args.folders.append(parts[2].strip())
-                    args.folders.append(parts[2].strip())
-                else:
-                    print(f"Skipping invalid folder entry: {folder.decode()}")
+    if (args.incremental or args.sync_deletions) and not args.state_db:
+        parser.error("--incremental and --sync-deletions require --state-db")
+    if args.sync_deletions and not args.incremental:
+        parser.error("--sync-deletions requires --incremental")
+
+    options = dict(create_folders=args.create_folders, skip_folders=args.skip_folders,
+                   recurse=args.recurse, skip=args.skip, limit=args.limit,
+                   batch_size=args.batch_size, batch_bytes=args.batch_bytes,
+                   workers=args.workers, max_conn_per_host=args.max_conn_per_host,
+                   shard_threshold=args.shard_threshold, max_shards=args.shards,
+                   state_db=args.state_db, incremental=args.incremental,
+                   sync_deletions=args.sync_deletions, max_memory=args.max_memory,
+                   spool_threshold=args.spool_threshold, server_side=args.server_side,
+                   move=args.move, timeout=args.timeout, retries=args.retries,
+                   max_backoff=args.max_backoff, metrics=args.metrics,
+                   prometheus=args.prometheus, metrics_interval=args.metrics_interval,
+                   compress=args.compress, large_message=args.large_message,
+                   large_timeout=args.large_timeout, cache=args.cache,
+                   cache_size=args.cache_size)
+
+    level = logging.WARNING
+    if not args.quiet:
+        level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
 
-            source_conn.logout()
-        elif len(args.folders) < 2:
-            print("Missing folders")
-            sys.exit(1)
-        elif len(args.folders) % 2 != 0:
-            print("Please provide an even number of folders")
-            sys.exit(1)
+    if args.manifest:
+        if args.source or args.folders:
+            parser.error("--manifest takes the accounts from the manifest, not from the command line")
+        try:
+            accounts = load_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            parser.error("cannot read manifest: %s" % e)
+
+        runner = BatchRunner(accounts, options, jobs=args.jobs, max_per_host=args.max_accounts_per_host,
+                             schedule=args.schedule, test=args.test_connections, deep=args.deep,
+                             level=level)
+        streamHandler = logging.StreamHandler()
+        streamHandler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        runner.logger.addHandler(streamHandler)
+        runner.logger.setLevel(level)
 
+        try:
+            clean = runner.run()
+        except KeyboardInterrupt:
+            clean = False
+        if args.report:
+            write_report(args.report, runner.results)
+        if not clean:
+            sys.exit(2)
+        return
 
+    if not args.destination_auth:
+        parser.error("source, source-auth, destination and destination-auth are required without --manifest")
 
-    # Sort the folders before creating the folder_mapping
-    args.folders.sort()
+    source = parse_server(args.source)
+    destination = parse_server(args.destination)
 
+    source_auth = parse_auth(args.source_auth)
+    destination_auth = parse_auth(args.destination_auth)
 
-    folder_mapping = list(zip(args.folders[::2], args.folders[1::2]))
+    # Without folders every folder of the source is copied, the list is
+    # taken from the folder tree once connected
+    if len(args.folders) % 2 != 0:
+        print("Please provide an even number of folders")
+        sys.exit(1)
 
-    # Debugging: Print sorted folder_mapping
-    # print("Sorted folder_mapping:", folder_mapping)
-    
+    # Sort the pairs by source folder so the mapping is deterministic
+    folder_mapping = sorted(zip(args.folders[::2], args.folders[1::2]))
 
     imap_copy = IMAP_Copy(source, destination, folder_mapping, source_auth,
-                          destination_auth, create_folders=args.create_folders, skip_folders=args.skip_folders,
-                          recurse=args.recurse, skip=args.skip, limit=args.limit)
+                          destination_auth, **options)
 
     streamHandler = logging.StreamHandler()
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
@@ -511,14 +3294,18 @@ def main():
         streamHandler.setLevel(logging.DEBUG)
         imap_copy.logger.setLevel(logging.DEBUG)
 
+    verified = True
     try:
         if args.test_connections:
-            imap_copy.test_connections()
+            verified = imap_copy.test_connections(args.deep)
         else:
             imap_copy.run()
     except KeyboardInterrupt:
         imap_copy.disconnect()
 
+    if imap_copy.failed_folders or not verified:
+        sys.exit(2)
+
 
 if __name__ == '__main__':
     main()
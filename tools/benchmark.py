@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark
+
+    Reproducible throughput benchmark for imapcopy.  Every scenario runs
+    IMAP_Copy in a fresh child process against a fake_imap server, in a
+    process of its own, filled with a seeded, configurable mix of folders
+    and message sizes, and reports messages/sec, bytes/sec, round trips
+    per message and the peak RSS of the child.  Results can be saved as a baseline
+    and later runs compared against it.
+
+    Scenarios:
+
+    cold     copy everything into an empty destination
+    resumed  copy again into a destination that already holds every
+             message, so everything is a duplicate
+    test     only connect and compare the folders (imapcopy --test)
+    deep     compare every message of a complete copy (imapcopy --test --deep)
+
+
+    :copyright: (c) 2013 by Christoph Heer.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import contextlib
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_imap  # noqa: E402
+import imapcopy  # noqa: E402
+
+SCENARIOS = ('cold', 'resumed', 'test', 'deep')
+
+# Metrics compared against the baseline, and whether bigger is better
+METRICS = (
+    ('messages_per_sec', True),
+    ('bytes_per_sec', True),
+    ('round_trips_per_message', False),
+    ('peak_rss', False),
+)
+
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    multiplier = units.get(value[-1:].upper(), 1)
+    number = value[:-1] if multiplier > 1 else value
+    return int(float(number) * multiplier)
+
+
+def parse_sizes(value):
+    # "2K:80,64K:15,2M:5" -> [[2048, 80], [65536, 15], [2097152, 5]]
+    sizes = []
+    for part in value.split(','):
+        size, _, weight = part.partition(':')
+        sizes.append([parse_size(size.strip()), float(weight or 1)])
+    return sizes
+
+
+def fill(store, config, folders):
+    # Fill a store with the same messages for the same configuration
+    rng = random.Random(config['seed'])
+    sizes = [size for size, weight in config['sizes']]
+    weights = [weight for size, weight in config['sizes']]
+    total = 0
+    for name in folders:
+        mailbox = store.get(name) or store.create(name)
+        for index in range(config['messages']):
+            body = fake_imap.make_message(index, rng.choices(sizes, weights)[0], folder=name)
+            mailbox.add(body, ('\\Seen',))
+            total += len(body)
+    return total
+
+
+def serve(scenario, config, folders, connection):
+    # Fake server of one scenario.  It runs in a process of its own so its
+    # mailboxes don't count towards the peak RSS of imapcopy.
+    server = fake_imap.FakeIMAPServer(latency=config['latency']).start()
+    total_bytes = fill(server.add_account('source', 'source'), config, folders)
+    destination = server.add_account('destination', 'destination')
+    if scenario in ('resumed', 'deep'):
+        fill(destination, config, folders)
+    connection.send((server.port, total_bytes))
+    while True:
+        command = connection.recv()
+        if command == 'reset':
+            server.reset_stats()
+            connection.send(None)
+        elif command == 'stats':
+            connection.send(dict(server.stats))
+        else:
+            break
+    server.stop()
+
+
+def run_scenario(scenario, config):
+    # Run one scenario in this process, against a server in another one,
+    # and return its measurements
+    folders = ['INBOX'] + ['Folder %d' % i for i in range(1, config['folders'])]
+    connection, server_connection = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(scenario, config, folders, server_connection),
+                                     daemon=True)
+    server.start()
+    try:
+        port, total_bytes = connection.recv()
+
+        address = {'host': '127.0.0.1', 'port': port}
+        imap_copy = imapcopy.IMAP_Copy(address, dict(address), [(f, f) for f in folders],
+                                       ('source', 'source'), ('destination', 'destination'),
+                                       create_folders=True, workers=config['workers'],
+                                       batch_size=config['batch_size'],
+                                       max_conn_per_host=config['max_conn_per_host'],
+                                       compress=config['compress'])
+        imap_copy.logger.setLevel(logging.ERROR)
+        connection.send('reset')
+        connection.recv()
+
+        start = time.perf_counter()
+        # imapcopy prints folder listings on stdout, which is where the
+        # results of this child go
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            if scenario in ('test', 'deep'):
+                imap_copy.test_connections(scenario == 'deep')
+            else:
+                imap_copy.run()
+        elapsed = time.perf_counter() - start
+        connection.send('stats')
+        stats = connection.recv()
+        connection.send('stop')
+    finally:
+        server.join(10)
+
+    messages = config['messages'] * config['folders'] if scenario != 'test' else 0
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    result = {
+        'elapsed': elapsed,
+        'messages': messages,
+        'copied': imap_copy.total_copied,
+        'round_trips': stats['commands'],
+        'connections': stats['connections'],
+        'wire_bytes': stats['bytes_in'] + stats['bytes_out'],
+        'peak_rss': peak_rss,
+    }
+    if messages:
+        result['messages_per_sec'] = messages / elapsed
+        result['bytes_per_sec'] = total_bytes / elapsed
+        result['round_trips_per_message'] = stats['commands'] / messages
+    return result
+
+
+def run_child(scenario, config):
+    # Every scenario gets a fresh interpreter so peak RSS is its own
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', scenario,
+                             '--config', json.dumps(config)],
+                            check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def compare(results, baseline, tolerance):
+    # Return the list of (scenario, metric, baseline, current) that got
+    # worse than the baseline by more than the tolerance
+    regressions = []
+    for scenario, result in results.items():
+        expected = baseline.get('results', {}).get(scenario, {})
+        for metric, higher_is_better in METRICS:
+            if metric not in result or not expected.get(metric):
+                continue
+            change = (result[metric] - expected[metric]) / expected[metric]
+            if higher_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append((scenario, metric, expected[metric], result[metric]))
+    return regressions
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return '%.2f' % value
+    return str(value)
+
+
+def report(results, baseline):
+    expected = baseline.get('results', {}) if baseline else {}
+    columns = ('elapsed', 'messages_per_sec', 'bytes_per_sec', 'round_trips_per_message', 'peak_rss')
+    print('%-8s %s' % ('scenario', ' '.join('%24s' % c for c in columns)))
+    for scenario, result in results.items():
+        cells = []
+        for column in columns:
+            cell = format_number(result.get(column, '-'))
+            old = expected.get(scenario, {}).get(column)
+            if old and column in result:
+                cell += ' (%+.0f%%)' % ((result[column] - old) * 100.0 / old)
+            cells.append('%24s' % cell)
+        print('%-8s %s' % (scenario, ' '.join(cells)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark imapcopy against a fake IMAP server")
+    parser.add_argument('--scenario', dest='scenarios', action='append', choices=SCENARIOS,
+                        help="scenario to run, may be given several times (default: all)")
+    parser.add_argument('--messages', type=int, default=500, metavar='N',
+                        help="messages per folder (default: %(default)s)")
+    parser.add_argument('--folders', type=int, default=2, metavar='N',
+                        help="number of folders (default: %(default)s)")
+    parser.add_argument('--sizes', default='2K:70,20K:25,500K:5', metavar='SIZE:WEIGHT,...',
+                        help="distribution of message sizes (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                        help="delay every command on the server by SECONDS (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="imapcopy --workers (default: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=imapcopy.BATCH_SIZE, metavar='N',
+                        help="imapcopy --batch-size (default: %(default)s)")
+    parser.add_argument('--max-conn-per-host', type=int, default=0, metavar='N',
+                        help="imapcopy --max-conn-per-host (default: %(default)s)")
+    parser.add_argument('--no-compress', dest='compress', action='store_false',
+                        help="imapcopy --no-compress")
+    parser.add_argument('--seed', type=int, default=1, help="random seed (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=1, metavar='N',
+                        help="run every scenario N times and keep the fastest run (default: %(default)s)")
+    parser.add_argument('--baseline', metavar='PATH',
+                        help="compare the results with the baseline stored in PATH")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results as the new baseline in --baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative change that counts as a regression (default: %(default)s)")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        json.dump(run_scenario(args.child, json.loads(args.config)), sys.stdout)
+        return
+
+    if args.save_baseline and not args.baseline:
+        parser.error("--save-baseline requires --baseline")
+
+    config = {
+        'messages': args.messages,
+        'folders': args.folders,
+        'sizes': parse_sizes(args.sizes),
+        'latency': args.latency,
+        'workers': args.workers,
+        'batch_size': args.batch_size,
+        'max_conn_per_host': args.max_conn_per_host,
+        'compress': args.compress,
+        'seed': args.seed,
+    }
+
+    results = {}
+    for scenario in args.scenarios or SCENARIOS:
+        runs = [run_child(scenario, config) for i in range(args.repeat)]
+        results[scenario] = min(runs, key=lambda run: run['elapsed'])
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print("Warning: baseline was recorded with a different configuration", file=sys.stderr)
+
+    if args.json:
+        json.dump({'config': config, 'results': results}, sys.stdout, indent=2)
+        print()
+    else:
+        report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+        print("Baseline saved to %s" % args.baseline, file=sys.stderr)
+    elif baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for scenario, metric, old, new in regressions:
+            print("Regression in %s: %s %s -> %s" % (
+                scenario, metric, format_number(old), format_number(new)), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,890 @@
+# -*- coding: utf-8 -*-
+"""
+    fake_imap
+
+    Small in-memory IMAP4rev1 server used to exercise and benchmark
+    imapcopy without a real mail server.  It implements the parts of the
+    protocol a migration needs, plus UIDPLUS, MOVE, CONDSTORE/QRESYNC,
+    LIST-STATUS and COMPRESS=DEFLATE.  Latency can be injected per command
+    to simulate hosted providers.
+
+
+    :copyright: (c) 2013 by Christoph Heer.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import re
+import time
+import zlib
+import socket
+import fnmatch
+import threading
+import socketserver
+
+CRLF = b'\r\n'
+
+DEFAULT_CAPABILITIES = ('IMAP4rev1', 'UIDPLUS', 'MOVE', 'CONDSTORE', 'QRESYNC',
+                        'ENABLE', 'LIST-STATUS', 'STATUS=SIZE',
+                        'COMPRESS=DEFLATE')
+
+_literal_re = re.compile(br'\{(\d+)\+?\}$')
+_header_fields_re = re.compile(r'^BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]$', re.I)
+_partial_re = re.compile(r'^BODY(?:\.PEEK)?\[\]<(\d+)\.(\d+)>$', re.I)
+
+
+class Message(object):
+    __slots__ = ('uid', 'flags', 'internaldate', 'body', 'modseq')
+
+    def __init__(self, uid, flags, internaldate, body, modseq):
+        self.uid = uid
+        self.flags = flags
+        self.internaldate = internaldate
+        self.body = body
+        self.modseq = modseq
+
+    def header_fields(self, names):
+        end = self.body.find(b'\r\n\r\n')
+        header = self.body[:end + 2] if end >= 0 else self.body
+        wanted = set(n.lower() for n in names)
+        out = []
+        keep = False
+        for line in header.split(b'\r\n'):
+            if not line:
+                continue
+            if line[:1] in (b' ', b'\t'):
+                if keep:
+                    out.append(line)
+                continue
+            name = line.split(b':', 1)[0].strip().decode('ascii', 'replace').lower()
+            keep = name in wanted
+            if keep:
+                out.append(line)
+        return b''.join(l + CRLF for l in out) + CRLF
+
+
+class Mailbox(object):
+
+    def __init__(self, name, uidvalidity):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []
+        self.highestmodseq = 1
+        self.vanished = []  # (uid, modseq) of expunged messages
+        self.subscribed = False
+
+    def next_modseq(self):
+        self.highestmodseq += 1
+        return self.highestmodseq
+
+    def add(self, body, flags=(), internaldate=None):
+        if internaldate is None:
+            internaldate = time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime())
+        msg = Message(self.uidnext, set(flags), internaldate, body,
+                      self.next_modseq())
+        self.uidnext += 1
+        self.messages.append(msg)
+        return msg
+
+    def expunge(self, uids=None):
+        kept = []
+        removed = []
+        for msg in self.messages:
+            if '\\Deleted' in msg.flags and (uids is None or msg.uid in uids):
+                removed.append(msg)
+            else:
+                kept.append(msg)
+        if removed:
+            modseq = self.next_modseq()
+            self.vanished.extend((m.uid, modseq) for m in removed)
+        self.messages = kept
+        return removed
+
+
+class Store(object):
+
+    def __init__(self, delimiter='/'):
+        self.delimiter = delimiter
+        self.mailboxes = {}
+        self.lock = threading.RLock()
+        self._uidvalidity = int(time.time()) % 100000 * 1000
+        self.create('INBOX')
+
+    def create(self, name):
+        with self.lock:
+            if name.upper() == 'INBOX':
+                name = 'INBOX'
+            if name not in self.mailboxes:
+                self._uidvalidity += 1
+                self.mailboxes[name] = Mailbox(name, self._uidvalidity)
+            return self.mailboxes[name]
+
+    def get(self, name):
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        return self.mailboxes.get(name)
+
+
+def parse_args(data):
+    # Tokenize a command argument string into atoms, strings and lists.
+    # Literals have already been inlined as bytes by the reader.
+    pos = 0
+    stack = [[]]
+    while pos < len(data):
+        c = data[pos:pos + 1]
+        if c == b' ':
+            pos += 1
+        elif c in (b'(', b'['):
+            stack.append([])
+            pos += 1
+        elif c in (b')', b']'):
+            inner = stack.pop()
+            stack[-1].append(inner)
+            pos += 1
+        elif c == b'"':
+            pos += 1
+            out = bytearray()
+            while data[pos:pos + 1] != b'"':
+                if data[pos:pos + 1] == b'\\':
+                    pos += 1
+                out += data[pos:pos + 1]
+                pos += 1
+            pos += 1
+            stack[-1].append(bytes(out))
+        elif c == b'\x00':
+            # Literal placeholder: \x00<index>\x00
+            end = data.index(b'\x00', pos + 1)
+            stack[-1].append(('literal', int(data[pos + 1:end])))
+            pos = end + 1
+        else:
+            end = pos
+            depth = 0
+            while end < len(data):
+                ch = data[end:end + 1]
+                if ch == b'[':
+                    depth += 1
+                elif ch == b']':
+                    if depth == 0:
+                        break
+                    depth -= 1
+                elif depth == 0 and ch in (b' ', b'(', b')'):
+                    break
+                end += 1
+            stack[-1].append(data[pos:end])
+            pos = end
+    return stack[0]
+
+
+def parse_seqset(text, maximum):
+    result = set()
+    for part in text.split(','):
+        if ':' in part:
+            lo, hi = part.split(':', 1)
+            lo = maximum if lo == '*' else int(lo)
+            hi = maximum if hi == '*' else int(hi)
+            if lo > hi:
+                lo, hi = hi, lo
+            result.update(range(lo, hi + 1))
+        else:
+            result.add(maximum if part == '*' else int(part))
+    return result
+
+
+def compact_set(numbers):
+    numbers = sorted(numbers)
+    out = []
+    i = 0
+    while i < len(numbers):
+        j = i
+        while j + 1 < len(numbers) and numbers[j + 1] == numbers[j] + 1:
+            j += 1
+        out.append(str(numbers[i]) if i == j else '%d:%d' % (numbers[i], numbers[j]))
+        i = j + 1
+    return ','.join(out)
+
+
+def quote(name):
+    return '"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.user = None
+        self.store = None
+        self.mailbox = None
+        self.readonly = False
+        self.condstore = False
+        self.qresync = False
+        self._compress = None
+        self._decompress = None
+        self._inbuf = b''
+
+    # -- transport ---------------------------------------------------
+
+    def _read_raw(self):
+        data = self.connection.recv(65536)
+        if not data:
+            raise EOFError()
+        self.server.stats_add('bytes_in', len(data))
+        if self._decompress is not None:
+            data = self._decompress.decompress(data)
+        return data
+
+    def readline(self):
+        while CRLF not in self._inbuf:
+            self._inbuf += self._read_raw()
+        line, self._inbuf = self._inbuf.split(CRLF, 1)
+        return line
+
+    def readexact(self, size):
+        while len(self._inbuf) < size:
+            self._inbuf += self._read_raw()
+        data, self._inbuf = self._inbuf[:size], self._inbuf[size:]
+        return data
+
+    def write(self, data):
+        if self._compress is not None:
+            data = self._compress.compress(data) + self._compress.flush(zlib.Z_SYNC_FLUSH)
+        self.server.stats_add('bytes_out', len(data))
+        self.connection.sendall(data)
+
+    def untagged(self, line):
+        self.write(b'* ' + (line.encode('utf-8') if isinstance(line, str) else line) + CRLF)
+
+    def read_command(self):
+        line = self.readline()
+        literals = []
+        parts = []
+        while True:
+            m = _literal_re.search(line)
+            if not m:
+                parts.append(line)
+                break
+            size = int(m.group(1))
+            if not line.rstrip().endswith(b'+}'):
+                self.write(b'+ Ready for literal data' + CRLF)
+            parts.append(line[:m.start()] + b'\x00%d\x00' % len(literals))
+            literals.append(self.readexact(size))
+            line = self.readline()
+        return b''.join(parts), literals
+
+    # -- main loop ---------------------------------------------------
+
+    def handle(self):
+        self.server.stats_add('connections', 1)
+        self.write(b'* OK [CAPABILITY %s] fake_imap ready' % self.capability_string()
+                   + CRLF)
+        try:
+            while True:
+                line, literals = self.read_command()
+                if not line.strip():
+                    continue
+                self.server.stats_add('commands', 1)
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                if not self.dispatch(line, literals):
+                    break
+        except (EOFError, ConnectionError, OSError):
+            pass
+
+    def capability_string(self):
+        return ' '.join(self.server.capabilities).encode('ascii')
+
+    def dispatch(self, line, literals):
+        tag, _, rest = line.partition(b' ')
+        tag = tag.decode('ascii')
+        command, _, rest = rest.partition(b' ')
+        command = command.decode('ascii').upper()
+        uid = False
+        if command == 'UID':
+            uid = True
+            command, _, rest = rest.partition(b' ')
+            command = command.decode('ascii').upper()
+        args = parse_args(rest)
+        args = [literals[a[1]] if isinstance(a, tuple) else a for a in args]
+
+        handler = getattr(self, 'do_' + command.replace('-', '_'), None)
+        drop = self.server.should_drop()
+        if drop:
+            if self.server.lose_replies and handler is not None and self.store is not None:
+                # The command takes effect, only its reply never arrives
+                self.write = lambda data: None
+                try:
+                    handler(tag, args, uid=True) if uid else handler(tag, args)
+                except Exception:
+                    pass
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return False
+
+        if handler is None:
+            self.write(('%s BAD unknown command %s' % (tag, command)).encode() + CRLF)
+            return True
+        if command not in ('CAPABILITY', 'LOGIN', 'LOGOUT', 'NOOP') and self.store is None:
+            self.write(('%s NO not authenticated' % tag).encode() + CRLF)
+            return True
+        if self.server.take_failure(getattr(self, 'user', None), ('UID ' if uid else '') + command):
+            self.write(('%s NO simulated failure' % tag).encode() + CRLF)
+            return True
+        try:
+            if uid:
+                result = handler(tag, args, uid=True)
+            else:
+                result = handler(tag, args)
+        except Exception as e:
+            self.write(('%s BAD %s' % (tag, e)).encode() + CRLF)
+            return True
+        if result is False:
+            return False
+        if result is True:
+            # The handler already sent the tagged response
+            return True
+        if result is None:
+            result = 'OK %s completed' % command
+        self.write(('%s %s' % (tag, result)).encode() + CRLF)
+        return command != 'LOGOUT'
+
+    # -- commands ----------------------------------------------------
+
+    def do_CAPABILITY(self, tag, args):
+        self.untagged(b'CAPABILITY ' + self.capability_string())
+
+    def do_NOOP(self, tag, args):
+        pass
+
+    def do_LOGIN(self, tag, args):
+        user, password = text(args[0]), text(args[1])
+        account = self.server.accounts.get(user)
+        if account is None or account[0] != password:
+            return 'NO [AUTHENTICATIONFAILED] invalid credentials'
+        self.user = user
+        self.store = account[1]
+
+    def do_LOGOUT(self, tag, args):
+        self.untagged('BYE logging out')
+        return 'OK LOGOUT completed'
+
+    def do_ENABLE(self, tag, args):
+        enabled = []
+        for cap in args:
+            cap = text(cap).upper()
+            if cap in ('CONDSTORE', 'QRESYNC') and cap in self.server.capabilities:
+                self.condstore = True
+                if cap == 'QRESYNC':
+                    self.qresync = True
+                enabled.append(cap)
+        self.untagged('ENABLED ' + ' '.join(enabled))
+
+    def do_COMPRESS(self, tag, args):
+        if 'COMPRESS=DEFLATE' not in self.server.capabilities:
+            return 'BAD compression not supported'
+        if self._compress is not None:
+            return 'NO [COMPRESSIONACTIVE] already compressing'
+        self.write(('%s OK DEFLATE active' % tag).encode() + CRLF)
+        self._compress = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self._decompress = zlib.decompressobj(-15)
+        # Anything already buffered was sent before compression started.
+        return True
+
+    def _listing(self, mbox):
+        attrs = '\\HasNoChildren'
+        prefix = mbox.name + self.store.delimiter
+        if any(n.startswith(prefix) for n in self.store.mailboxes):
+            attrs = '\\HasChildren'
+        return '(%s) %s %s' % (attrs, quote(self.store.delimiter), quote(mbox.name))
+
+    def do_LIST(self, tag, args):
+        reference, pattern = text(args[0]), text(args[1])
+        status_items = None
+        if len(args) > 2 and text(args[2]).upper() == 'RETURN':
+            opts = args[3]
+            for i, opt in enumerate(opts):
+                if not isinstance(opt, list) and text(opt).upper() == 'STATUS':
+                    status_items = [text(x).upper() for x in opts[i + 1]]
+        if pattern == '':
+            self.untagged('LIST (\\Noselect) %s ""' % quote(self.store.delimiter))
+            return
+        full = reference + pattern
+        glob = full.replace('*', '\x01').replace('%', '\x02')
+        glob = glob.replace('\x01', '*').replace('\x02', '*')
+        with self.store.lock:
+            names = sorted(self.store.mailboxes)
+            for name in names:
+                if '%' in full and self.store.delimiter in name[len(reference):] \
+                        and '*' not in full:
+                    continue
+                if not fnmatch.fnmatchcase(name, glob) and \
+                        not (full.upper() == 'INBOX' and name == 'INBOX'):
+                    continue
+                mbox = self.store.mailboxes[name]
+                self.untagged('LIST ' + self._listing(mbox))
+                if status_items:
+                    self.untagged('STATUS %s (%s)' % (quote(name), self._status(mbox, status_items)))
+
+    def do_LSUB(self, tag, args):
+        with self.store.lock:
+            for name in sorted(self.store.mailboxes):
+                mbox = self.store.mailboxes[name]
+                if mbox.subscribed:
+                    self.untagged('LSUB ' + self._listing(mbox))
+
+    def do_CREATE(self, tag, args):
+        name = text(args[0])
+        with self.store.lock:
+            if self.store.get(name) is not None:
+                return 'NO [ALREADYEXISTS] mailbox exists'
+            self.store.create(name)
+
+    def do_SUBSCRIBE(self, tag, args):
+        mbox = self.store.get(text(args[0]))
+        if mbox is None:
+            return 'NO no such mailbox'
+        mbox.subscribed = True
+
+    def _status(self, mbox, items):
+        out = []
+        for item in items:
+            if item == 'MESSAGES':
+                out.append('MESSAGES %d' % len(mbox.messages))
+            elif item == 'UIDNEXT':
+                out.append('UIDNEXT %d' % mbox.uidnext)
+            elif item == 'UIDVALIDITY':
+                out.append('UIDVALIDITY %d' % mbox.uidvalidity)
+            elif item == 'UNSEEN':
+                out.append('UNSEEN %d' % sum(1 for m in mbox.messages
+                                             if '\\Seen' not in m.flags))
+            elif item == 'RECENT':
+                out.append('RECENT 0')
+            elif item == 'HIGHESTMODSEQ' and 'CONDSTORE' in self.server.capabilities:
+                out.append('HIGHESTMODSEQ %d' % mbox.highestmodseq)
+            elif item == 'SIZE' and 'STATUS=SIZE' in self.server.capabilities:
+                out.append('SIZE %d' % sum(len(m.body) for m in mbox.messages))
+        return ' '.join(out)
+
+    def do_STATUS(self, tag, args):
+        mbox = self.store.get(text(args[0]))
+        if mbox is None:
+            return 'NO [NONEXISTENT] no such mailbox'
+        items = [text(x).upper() for x in args[1]]
+        with self.store.lock:
+            self.untagged('STATUS %s (%s)' % (quote(mbox.name), self._status(mbox, items)))
+
+    def _select(self, tag, args, readonly):
+        mbox = self.store.get(text(args[0]))
+        if mbox is None:
+            self.mailbox = None
+            return 'NO [NONEXISTENT] no such mailbox'
+        qresync = None
+        if len(args) > 1 and isinstance(args[1], list):
+            params = args[1]
+            for i, p in enumerate(params):
+                if isinstance(p, bytes) and p.upper() == b'CONDSTORE':
+                    self.condstore = True
+                elif isinstance(p, bytes) and p.upper() == b'QRESYNC':
+                    qresync = params[i + 1]
+        self.mailbox = mbox
+        self.readonly = readonly
+        with self.store.lock:
+            self.untagged('FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+            self.untagged('%d EXISTS' % len(mbox.messages))
+            self.untagged('0 RECENT')
+            self.untagged('OK [UIDVALIDITY %d] UIDs valid' % mbox.uidvalidity)
+            self.untagged('OK [UIDNEXT %d] Predicted next UID' % mbox.uidnext)
+            if 'CONDSTORE' in self.server.capabilities:
+                self.untagged('OK [HIGHESTMODSEQ %d] Highest' % mbox.highestmodseq)
+            if qresync and self.qresync and int(qresync[0]) == mbox.uidvalidity:
+                since = int(qresync[1])
+                gone = [u for u, m in mbox.vanished if m > since]
+                if gone:
+                    self.untagged('VANISHED (EARLIER) %s' % compact_set(gone))
+                for seq, msg in enumerate(mbox.messages, 1):
+                    if msg.modseq > since:
+                        self.untagged('%d FETCH (UID %d FLAGS (%s) MODSEQ (%d))' % (
+                            seq, msg.uid, ' '.join(sorted(msg.flags)), msg.modseq))
+        return 'OK [%s] %s completed' % ('READ-ONLY' if readonly else 'READ-WRITE',
+                                         'EXAMINE' if readonly else 'SELECT')
+
+    def do_SELECT(self, tag, args):
+        return self._select(tag, args, False)
+
+    def do_EXAMINE(self, tag, args):
+        return self._select(tag, args, True)
+
+    def do_CLOSE(self, tag, args):
+        if self.mailbox is not None and not self.readonly:
+            with self.store.lock:
+                self.mailbox.expunge()
+        self.mailbox = None
+
+    def do_UNSELECT(self, tag, args):
+        self.mailbox = None
+
+    def do_EXPUNGE(self, tag, args, uid=False):
+        if self.mailbox is None:
+            return 'BAD no mailbox selected'
+        with self.store.lock:
+            uids = None
+            if uid:
+                uids = parse_seqset(text(args[0]), self.mailbox.uidnext - 1)
+            seqs = {m.uid: i for i, m in enumerate(self.mailbox.messages, 1)}
+            removed = self.mailbox.expunge(uids)
+            for msg in sorted(removed, key=lambda m: -seqs[m.uid]):
+                self.untagged('%d EXPUNGE' % seqs[msg.uid])
+
+    def _resolve(self, setspec, uid):
+        msgs = self.mailbox.messages
+        if uid:
+            maximum = msgs[-1].uid if msgs else 0
+            wanted = parse_seqset(setspec, maximum)
+            return [(i, m) for i, m in enumerate(msgs, 1) if m.uid in wanted]
+        wanted = parse_seqset(setspec, len(msgs))
+        return [(i, m) for i, m in enumerate(msgs, 1) if i in wanted]
+
+    def do_SEARCH(self, tag, args, uid=False):
+        if self.mailbox is None:
+            return 'BAD no mailbox selected'
+        with self.store.lock:
+            matches = list(enumerate(self.mailbox.messages, 1))
+            i = 0
+            while i < len(args):
+                key = text(args[i]).upper()
+                if key == 'ALL':
+                    i += 1
+                elif key == 'HEADER':
+                    field, value = text(args[i + 1]), args[i + 2]
+                    matches = [(s, m) for s, m in matches
+                               if value.lower() in m.header_fields([field]).lower()]
+                    i += 3
+                elif key == 'UID':
+                    maximum = self.mailbox.messages[-1].uid if self.mailbox.messages else 0
+                    wanted = parse_seqset(text(args[i + 1]), maximum)
+                    matches = [(s, m) for s, m in matches if m.uid in wanted]
+                    i += 2
+                elif key == 'MODSEQ':
+                    since = int(args[i + 1])
+                    matches = [(s, m) for s, m in matches if m.modseq > since]
+                    i += 2
+                elif key == 'CHARSET':
+                    i += 2
+                elif re.match(r'^[\d*:,]+$', key):
+                    # A bare sequence set selects by message sequence number
+                    wanted = parse_seqset(key, len(self.mailbox.messages))
+                    matches = [(s, m) for s, m in matches if s in wanted]
+                    i += 1
+                else:
+                    i += 1
+            self.untagged('SEARCH' + ''.join(' %d' % (m.uid if uid else s)
+                                             for s, m in matches))
+
+    def _fetch_items(self, msg, seq, items, uid):
+        parts = []
+        if uid and not any(isinstance(n, bytes) and n.upper() == b'UID' for n in items):
+            parts.append(b'UID %d' % msg.uid)
+        for item in items:
+            if isinstance(item, list):
+                continue
+            name = text(item)
+            upper = name.upper()
+            if upper == 'UID':
+                parts.append(b'UID %d' % msg.uid)
+            elif upper == 'FLAGS':
+                parts.append(('FLAGS (%s)' % ' '.join(sorted(msg.flags))).encode())
+            elif upper == 'INTERNALDATE':
+                parts.append(('INTERNALDATE "%s"' % msg.internaldate).encode())
+            elif upper == 'RFC822.SIZE':
+                parts.append(b'RFC822.SIZE %d' % len(msg.body))
+            elif upper == 'MODSEQ':
+                parts.append(b'MODSEQ (%d)' % msg.modseq)
+            elif upper in ('RFC822', 'BODY[]', 'BODY.PEEK[]'):
+                label = b'RFC822' if upper == 'RFC822' else b'BODY[]'
+                parts.append(label + b' {%d}\r\n' % len(msg.body) + msg.body)
+            elif upper in ('RFC822.HEADER', 'BODY.PEEK[HEADER]', 'BODY[HEADER]'):
+                end = msg.body.find(b'\r\n\r\n')
+                header = msg.body[:end + 4] if end >= 0 else msg.body
+                parts.append(b'RFC822.HEADER {%d}\r\n' % len(header) + header)
+            else:
+                m = _header_fields_re.match(name)
+                if m:
+                    fields = m.group(1).split()
+                    data = msg.header_fields(fields)
+                    label = ('BODY[HEADER.FIELDS (%s)]' % ' '.join(f.upper() for f in fields))
+                    parts.append(label.encode() + b' {%d}\r\n' % len(data) + data)
+                    continue
+                m = _partial_re.match(name)
+                if m:
+                    start, length = int(m.group(1)), int(m.group(2))
+                    data = msg.body[start:start + length]
+                    parts.append(b'BODY[]<%d> {%d}\r\n' % (start, len(data)) + data)
+                    continue
+                raise ValueError('unsupported fetch item %s' % name)
+        return b'%d FETCH (' % seq + b' '.join(parts) + b')'
+
+    def do_FETCH(self, tag, args, uid=False):
+        if self.mailbox is None:
+            return 'BAD no mailbox selected'
+        setspec = text(args[0])
+        spec = args[1]
+        modifiers = args[2] if len(args) > 2 else []
+        if isinstance(spec, list):
+            items = spec
+        else:
+            items = [spec]
+        macro = [text(i).upper() for i in items]
+        if macro == ['ALL']:
+            items = [b'FLAGS', b'INTERNALDATE', b'RFC822.SIZE']
+        changedsince = None
+        vanished = False
+        i = 0
+        while i < len(modifiers):
+            key = text(modifiers[i]).upper()
+            if key == 'CHANGEDSINCE':
+                changedsince = int(modifiers[i + 1])
+                i += 2
+            elif key == 'VANISHED':
+                vanished = True
+                i += 1
+            else:
+                i += 1
+        if changedsince is not None:
+            self.condstore = True
+            if not any(text(x).upper() == 'MODSEQ' for x in items):
+                items.append(b'MODSEQ')
+        with self.store.lock:
+            if vanished and uid and changedsince is not None:
+                maximum = self.mailbox.uidnext - 1
+                wanted = parse_seqset(setspec, maximum)
+                gone = [u for u, m in self.mailbox.vanished
+                        if m > changedsince and u in wanted]
+                if gone:
+                    self.untagged('VANISHED (EARLIER) %s' % compact_set(gone))
+            for seq, msg in self._resolve(setspec, uid):
+                if changedsince is not None and msg.modseq <= changedsince:
+                    continue
+                self.untagged(self._fetch_items(msg, seq, items, uid))
+                peek = all('PEEK' in text(x).upper() or not text(x).upper().startswith(('BODY', 'RFC822'))
+                           or text(x).upper() in ('RFC822.SIZE', 'RFC822.HEADER') for x in items)
+                if not peek and not self.readonly and '\\Seen' not in msg.flags:
+                    msg.flags.add('\\Seen')
+                    msg.modseq = self.mailbox.next_modseq()
+
+    def do_STORE(self, tag, args, uid=False):
+        if self.mailbox is None:
+            return 'BAD no mailbox selected'
+        setspec = text(args[0])
+        rest = args[1:]
+        unchangedsince = None
+        if rest and isinstance(rest[0], list):
+            mods = rest[0]
+            if len(mods) == 2 and text(mods[0]).upper() == 'UNCHANGEDSINCE':
+                unchangedsince = int(mods[1])
+            rest = rest[1:]
+        action = text(rest[0]).upper()
+        flags = rest[1] if isinstance(rest[1], list) else rest[1:]
+        flags = set(text(f) for f in flags)
+        silent = action.endswith('.SILENT')
+        action = action.replace('.SILENT', '')
+        with self.store.lock:
+            for seq, msg in self._resolve(setspec, uid):
+                if unchangedsince is not None and msg.modseq > unchangedsince:
+                    continue
+                before = set(msg.flags)
+                if action == 'FLAGS':
+                    msg.flags = set(flags)
+                elif action == '+FLAGS':
+                    msg.flags |= flags
+                elif action == '-FLAGS':
+                    msg.flags -= flags
+                if msg.flags != before:
+                    msg.modseq = self.mailbox.next_modseq()
+                if not silent:
+                    self.untagged('%d FETCH (%sFLAGS (%s))' % (
+                        seq, 'UID %d ' % msg.uid if uid else '',
+                        ' '.join(sorted(msg.flags))))
+
+    def _copy(self, tag, args, uid, move):
+        if self.mailbox is None:
+            return 'BAD no mailbox selected'
+        target = self.store.get(text(args[1]))
+        if target is None:
+            return 'NO [TRYCREATE] no such mailbox'
+        with self.store.lock:
+            src_uids = []
+            dst_uids = []
+            msgs = self._resolve(text(args[0]), uid)
+            for seq, msg in msgs:
+                new = target.add(msg.body, set(msg.flags) - {'\\Recent'}, msg.internaldate)
+                src_uids.append(msg.uid)
+                dst_uids.append(new.uid)
+            code = ''
+            if src_uids and 'UIDPLUS' in self.server.capabilities:
+                code = '[COPYUID %d %s %s] ' % (
+                    target.uidvalidity, ','.join(map(str, src_uids)),
+                    ','.join(map(str, dst_uids)))
+            if move:
+                if code:
+                    self.untagged('OK ' + code + 'Moved UIDs.')
+                for seq, msg in sorted(msgs, key=lambda x: -x[0]):
+                    msg.flags.add('\\Deleted')
+                self.mailbox.expunge(set(src_uids))
+                for seq, msg in sorted(msgs, key=lambda x: -x[0]):
+                    self.untagged('%d EXPUNGE' % seq)
+                return 'OK MOVE completed'
+        return 'OK %sCOPY completed' % code
+
+    def do_COPY(self, tag, args, uid=False):
+        return self._copy(tag, args, uid, False)
+
+    def do_MOVE(self, tag, args, uid=False):
+        if 'MOVE' not in self.server.capabilities:
+            return 'BAD MOVE not supported'
+        return self._copy(tag, args, uid, True)
+
+    def do_APPEND(self, tag, args):
+        name = text(args[0])
+        flags = ()
+        internaldate = None
+        rest = args[1:]
+        if rest and isinstance(rest[0], list):
+            flags = [text(f) for f in rest[0]]
+            rest = rest[1:]
+        if len(rest) > 1:
+            internaldate = text(rest[0])
+            rest = rest[1:]
+        body = rest[0]
+        with self.store.lock:
+            mbox = self.store.get(name)
+            if mbox is None:
+                return 'NO [TRYCREATE] no such mailbox'
+            msg = mbox.add(bytes(body), flags, internaldate)
+            self.server.stats_add('appended', 1)
+            if self.mailbox is mbox:
+                self.untagged('%d EXISTS' % len(mbox.messages))
+        if 'UIDPLUS' in self.server.capabilities:
+            return 'OK [APPENDUID %d %d] APPEND completed' % (mbox.uidvalidity, msg.uid)
+        return 'OK APPEND completed'
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0,
+                 capabilities=DEFAULT_CAPABILITIES, drop_every=0, lose_replies=False):
+        super().__init__(address, IMAPHandler)
+        self.latency = latency
+        self.capabilities = tuple(capabilities)
+        self.accounts = {}
+        self.drop_every = drop_every
+        # Execute the dropped commands before closing the connection, as if
+        # only the reply got lost
+        self.lose_replies = lose_replies
+        # (user, command) -> number of times the command is answered NO
+        self.failures = {}
+        self.stats = {'connections': 0, 'commands': 0, 'bytes_in': 0,
+                      'bytes_out': 0, 'appended': 0}
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add_account(self, user, password, store=None):
+        if store is None:
+            store = Store()
+        self.accounts[user] = (password, store)
+        return store
+
+    def stats_add(self, key, value):
+        with self._stats_lock:
+            self.stats[key] += value
+
+    def should_drop(self):
+        # Simulate a provider dropping the connection every N commands.
+        if not self.drop_every:
+            return False
+        with self._stats_lock:
+            return self.stats['commands'] % self.drop_every == 0
+
+    def fail(self, user, command, times=1):
+        # Answer the next `times` commands of user, e.g. 'UID SEARCH', with NO
+        with self._stats_lock:
+            self.failures[(user, command.upper())] = times
+
+    def take_failure(self, user, command):
+        with self._stats_lock:
+            left = self.failures.get((user, command), 0)
+            if left:
+                self.failures[(user, command)] = left - 1
+            return bool(left)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_message(index, size=2048, message_id=True, folder='INBOX'):
+    headers = [
+        'From: sender%d@example.com' % (index % 97),
+        'To: user@example.com',
+        'Subject: Message %d in %s' % (index, folder),
+        'Date: Mon, 1 Jan 2024 00:%02d:%02d +0000' % (index // 60 % 60, index % 60),
+    ]
+    if message_id:
+        headers.append('Message-ID: <%d.%s@fake.example.com>' % (
+            index, folder.replace(' ', '_').replace('/', '.')))
+    headers.append('Content-Type: text/plain; charset=us-ascii')
+    head = '\r\n'.join(headers).encode('ascii') + b'\r\n\r\n'
+    line = b'Lorem ipsum dolor sit amet, consectetur adipiscing elit %08d.\r\n' % index
+    return head + line * (max(size - len(head), 0) // len(line))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run an in-memory IMAP server for testing imapcopy")
+    parser.add_argument('--port', type=int, default=1143,
+                        help="port to listen on (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                        help="delay every command by SECONDS")
+    parser.add_argument('--account', action='append', default=[], metavar='USER:PASSWORD',
+                        help="add an account, may be given several times")
+    parser.add_argument('--messages', type=int, default=0, metavar='N',
+                        help="fill the INBOX of the first account with N messages")
+    args = parser.parse_args()
+
+    server = FakeIMAPServer(('127.0.0.1', args.port), latency=args.latency)
+    for i, account in enumerate(args.account or ['source:source', 'destination:destination']):
+        user, password = account.split(':', 1)
+        store = server.add_account(user, password)
+        if i == 0:
+            inbox = store.get('INBOX')
+            for n in range(args.messages):
+                inbox.add(make_message(n))
+    print("Listening on 127.0.0.1:%d" % server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+    parse_benchmark
+
+    Micro-benchmark of imapcopy.parse_fetch.  Builds FETCH results the way
+    imaplib hands them over (lines, with every literal split off into a
+    (line, literal) tuple) for the two kinds of FETCH imapcopy sends, and
+    reports how many messages and bytes per second are parsed.
+
+    Shapes:
+
+    plan     UID, FLAGS, RFC822.SIZE, INTERNALDATE and a few header fields
+             per message, as fetched while planning a copy
+    body     UID and the full message, as fetched for copying
+    mixed    the attributes spread before and after the literal and in a
+             different order for every message
+
+
+    :copyright: (c) 2013 by Christoph Heer.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_imap  # noqa: E402
+import imapcopy  # noqa: E402
+
+SHAPES = ('plan', 'body', 'mixed')
+
+
+def build_response(shape, messages, size):
+    # FETCH result of `messages` messages and the number of literal bytes
+    # in it
+    data = []
+    total = 0
+    for index in range(messages):
+        uid = index + 1
+        date = b'"01-Jan-2024 00:%02d:%02d +0000"' % (index // 60 % 60, index % 60)
+        if shape == 'plan':
+            header = b'Message-ID: <%d@fake.example.com>\r\nSubject: Message %d\r\n\r\n' % (index, index)
+            data.append((b'%d (UID %d FLAGS (\\Seen $Forwarded) RFC822.SIZE %d INTERNALDATE %s '
+                         b'BODY[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)] {%d}' % (
+                             index + 1, uid, size, date, len(header)), header))
+            data.append(b')')
+            total += len(header)
+        else:
+            body = fake_imap.make_message(index, size)
+            if shape == 'body' or index % 2:
+                data.append((b'%d (UID %d BODY[] {%d}' % (index + 1, uid, len(body)), body))
+                data.append(b')')
+            else:
+                data.append((b'%d (FLAGS (\\Seen) BODY[] {%d}' % (index + 1, len(body)), body))
+                data.append(b' INTERNALDATE %s UID %d RFC822.SIZE %d)' % (date, uid, len(body)))
+            total += len(body)
+    return data, total
+
+
+def run_shape(shape, messages, size, repeat):
+    data, total = build_response(shape, messages, size)
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        records = imapcopy.parse_fetch(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    if len(records) != messages or records[-1]['uid'] != messages:
+        raise AssertionError("%s: parsed %d of %d messages" % (shape, len(records), messages))
+    return {
+        'elapsed': best,
+        'messages': messages,
+        'messages_per_sec': messages / best,
+        'bytes_per_sec': total / best,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing of FETCH responses")
+    parser.add_argument('--shape', dest='shapes', action='append', choices=SHAPES,
+                        help="response shape to parse, may be given several times (default: all)")
+    parser.add_argument('--messages', type=int, default=10000, metavar='N',
+                        help="messages per response (default: %(default)s)")
+    parser.add_argument('--size', type=int, default=20000, metavar='BYTES',
+                        help="size of every message (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5, metavar='N',
+                        help="parse every response N times and keep the fastest run (default: %(default)s)")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for shape in args.shapes or SHAPES:
+        results[shape] = run_shape(shape, args.messages, args.size, args.repeat)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print('%-8s %12s %18s %18s' % ('shape', 'elapsed', 'messages_per_sec', 'bytes_per_sec'))
+    for shape, result in results.items():
+        print('%-8s %12.4f %18.0f %18.0f' % (
+            shape, result['elapsed'], result['messages_per_sec'], result['bytes_per_sec']))
+
+
+if __name__ == '__main__':
+    main()